@@ -1,3 +1,4 @@
 # Make some package level imports
 from rough_clustering import RoughCluster
-from rough_kmeans import RoughKMeans
\ No newline at end of file
+from rough_kmeans import RoughKMeans
+from data_loader import ColumnLoader
@@ -0,0 +1,269 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+@description
+Columnar loader of CSV, JSON-lines (.jsonl), JSON column (.json) and numpy (.npy/.npz) files into typed numpy column
+arrays, as a dictionary of <feature_name> : array pairs that can be passed directly to RoughCluster and RoughKMeans
+
+Files are read in chunks of rows, and each column is converted to an array in bulk: integral numeric columns to
+int64, other numeric columns to self.dtype, and non-numeric (or self.categorical) columns are encoded to integer
+codes. Codes are consistent across chunks, and the category of code c of column name is self.categories[name][c]
+
+Blank cells (empty strings or JSON null) of numeric columns are missing values loaded as NaN, so a numeric column
+with blanks is loaded as self.dtype
+
+@options
+    self.columns = columns          # Names of columns to load, in order (None for all columns in file order)
+    self.categorical = categorical  # Names of columns to always encode as categories (None to detect non-numeric)
+    self.dtype = np.float64         # Float type of non-integral numeric columns
+    self.chunk_size = 100000        # Number of rows read at once
+    self.delimiter = ","            # Field delimiter of CSV files (first line is the header)
+    self.key = None                 # Key of column dictionary in JSON column files (e.g. "data_set")
+
+@notes
+.npy files hold either a structured array (columns are fields) or a 2-D array (columns are named "0", "1", ... unless
+self.columns is given) and are memory-mapped so chunks are read lazily. .npz files hold one 1-D array per column
+
+The type of each column is settled by the first chunk. A column detected as numeric in the first chunk that holds
+non-numeric values in a later chunk raises ValueError (list it in self.categorical). An integral column whose later
+chunks hold non-integral or missing values is loaded as self.dtype by load(), while chunks() raises ValueError as
+earlier chunks were already returned as int64 (increase self.chunk_size)
+"""
+
+# Externals
+import os
+import csv
+import json
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+
+class ColumnLoader:
+
+    def __init__(self,filename,columns=None,categorical=None):
+
+        # Loader options
+        self.filename = filename            # Path of CSV, JSON-lines, JSON column, .npy or .npz file
+        self.columns = columns              # Names of columns to load, in order (None for all columns)
+        self.categorical = categorical      # Names of columns to always encode as categories (None to detect)
+        self.dtype = np.float64             # Float type of non-integral numeric columns
+        self.chunk_size = 100000            # Number of rows read at once
+        self.delimiter = ","                # Field delimiter of CSV files
+        self.key = None                     # Key of column dictionary in JSON column files
+
+        # Loader output vars
+        self.categories = {}                # Category values (in order of code) of each encoded column
+        self.category_codes = {}            # Category value : code of each encoded column
+        self.numeric = set()                # Names of columns loaded as numeric
+        self.integral = set()               # Names of numeric columns loaded as int64
+
+    def load(self):
+
+        """
+        Load all rows of the file
+
+        :return: OrderedDict of column name : typed array
+        """
+
+        columns = OrderedDict()
+        chunks = list(self.chunks(promote=True))
+        if len(chunks) == 0:
+            return columns
+        for name in chunks[0]:
+            columns[name] = np.concatenate([chunk[name] for chunk in chunks])
+            if name in self.numeric and name not in self.integral:
+                columns[name] = columns[name].astype(self.dtype,copy=False)
+
+        return columns
+
+    def chunks(self,promote=False):
+
+        """
+        Read file in chunks of self.chunk_size rows
+
+        :arg (optional) promote : True to settle an integral column as self.dtype when a later chunk holds
+            non-integral or missing values (earlier chunks are left as int64), instead of raising ValueError
+        :return: generator of OrderedDict of column name : typed array for each chunk
+        """
+
+        extension = os.path.splitext(self.filename)[1].lower()
+        if extension == ".npy":
+            raw_chunks = self.read_npy()
+        elif extension == ".npz":
+            raw_chunks = self.read_npz()
+        elif extension == ".jsonl":
+            raw_chunks = self.read_json_lines()
+        elif extension == ".json":
+            raw_chunks = self.read_json_columns()
+        else:
+            raw_chunks = self.read_csv()
+
+        for raw in raw_chunks:
+            yield OrderedDict((name,self.convert(name,values,promote)) for name,values in raw.iteritems())
+
+    def read_csv(self):
+
+        """
+        :return: generator of OrderedDict of column name : string array for each chunk of CSV rows
+        """
+
+        with open(self.filename,"r") as csv_file:
+            reader = csv.reader(csv_file,delimiter=self.delimiter)
+            header = next(reader)
+            names = self.columns if self.columns is not None else header
+            select = [header.index(name) for name in names]
+            while True:
+                rows = list(itertools.islice(reader,self.chunk_size))
+                if len(rows) == 0:
+                    return
+                table = np.array(rows,dtype=str)
+                yield OrderedDict((name,table[:,i]) for name,i in itertools.izip(names,select))
+
+    def read_json_lines(self):
+
+        """
+        :return: generator of OrderedDict of column name : array for each chunk of JSON-lines rows
+        """
+
+        names = self.columns
+        with open(self.filename,"r") as json_file:
+            lines = (line for line in json_file if line.strip())
+            while True:
+                rows = [json.loads(line,object_pairs_hook=OrderedDict)
+                        for line in itertools.islice(lines,self.chunk_size)]
+                if len(rows) == 0:
+                    return
+                if names is None:
+                    names = rows[0].keys()
+                yield OrderedDict((name,np.array([row[name] for row in rows])) for name in names)
+
+    def read_json_columns(self):
+
+        """
+        :return: generator of OrderedDict of column name : array for each chunk of a JSON column dictionary
+        """
+
+        with open(self.filename,"r") as json_file:
+            data = json.load(json_file,object_pairs_hook=OrderedDict)
+        if self.key is not None:
+            data = data[self.key]
+        names = self.columns if self.columns is not None else data.keys()
+        columns = [(name,np.asarray(data[name])) for name in names]
+        del data
+        for k in range(0,len(columns[0][1]),self.chunk_size):
+            yield OrderedDict((name,values[k:k+self.chunk_size]) for name,values in columns)
+
+    def read_npy(self):
+
+        """
+        :return: generator of OrderedDict of column name : array for each chunk of a memory-mapped .npy array
+        """
+
+        array = np.load(self.filename,mmap_mode="r")
+        if array.dtype.names is not None:
+            names = self.columns if self.columns is not None else array.dtype.names
+            select = names
+        else:
+            names = self.columns if self.columns is not None else [str(i) for i in range(array.shape[1])]
+            select = range(len(names))
+        for k in range(0,array.shape[0],self.chunk_size):
+            block = array[k:k+self.chunk_size]
+            if array.dtype.names is not None:
+                yield OrderedDict((name,np.asarray(block[field])) for name,field in itertools.izip(names,select))
+            else:
+                yield OrderedDict((name,np.asarray(block[:,i])) for name,i in itertools.izip(names,select))
+
+    def read_npz(self):
+
+        """
+        :return: generator of OrderedDict of column name : array for each chunk of .npz column arrays
+        """
+
+        archive = np.load(self.filename,mmap_mode="r")
+        try:
+            names = self.columns if self.columns is not None else archive.files
+            columns = [(name,archive[name]) for name in names]
+            for k in range(0,len(columns[0][1]),self.chunk_size):
+                yield OrderedDict((name,np.asarray(values[k:k+self.chunk_size])) for name,values in columns)
+        finally:
+            archive.close()
+
+    def convert(self,name,values,promote=False):
+
+        """
+        Convert raw column values to an int64, self.dtype or (encoded) categorical array, of the type settled by
+        the first chunk of the column
+
+        :arg name : column name
+        :arg values : array of raw column values
+        :arg (optional) promote : True to settle an integral column as self.dtype if values are non-integral
+        :return: typed array of column values
+        """
+
+        if name in self.categories or (self.categorical is not None and name in self.categorical):
+            return self.encode(name,values)
+        numeric = self.to_float(values)
+        if numeric is None:
+            if name in self.numeric:
+                raise ValueError("Column %s has non-numeric values after numeric rows, list it in categorical" % name)
+            return self.encode(name,values)
+
+        integral = values.dtype.kind in "biu" or bool(np.all(np.mod(numeric,1) == 0))
+        if name not in self.numeric:
+            self.numeric.add(name)
+            if integral is True:
+                self.integral.add(name)
+        elif name in self.integral and integral is False:
+            if promote is not True:
+                raise ValueError("Column %s has non-integral or missing values after integral rows, increase "
+                                 "chunk_size" % name)
+            self.integral.remove(name)
+
+        if name in self.integral:
+            return values.astype(np.int64) if values.dtype.kind in "biu" else numeric.astype(np.int64)
+        return numeric.astype(self.dtype)
+
+    @staticmethod
+    def to_float(values):
+
+        """
+        :arg values : array of raw column values
+        :return: float64 array of values with blank (or null) values as NaN, or None if any value is non-numeric
+        """
+
+        if values.dtype.kind in "biuf":
+            return values.astype(np.float64)
+        if values.dtype.kind in "SU":
+            values = np.where(np.char.strip(values) == "","nan",values)
+        elif values.dtype.kind == "O":
+            values = np.array([np.nan if value is None or value == "" else value for value in values],dtype=object)
+        try:
+            return values.astype(np.float64)
+        except (ValueError,TypeError):
+            return None
+
+    def encode(self,name,values):
+
+        """
+        Encode column values to integer category codes, continuing the codes of earlier chunks
+
+        :arg name : column name
+        :arg values : array of category values
+        :return: int32 array of codes
+        """
+
+        unique,inverse = np.unique(values,return_inverse=True)
+        codes = self.category_codes.setdefault(name,{})
+        new = [value for value in unique.tolist() if value not in codes]
+        for value in new:
+            codes[value] = len(codes)
+        if len(new) > 0:
+            categories = np.asarray(new)
+            if name in self.categories:
+                categories = np.concatenate((self.categories[name],categories))
+            self.categories[name] = categories
+        lookup = np.asarray([codes[value] for value in unique.tolist()],dtype=np.int32)
+
+        return lookup[inverse]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+@description
+Opt-in memory profiling of rough clustering phases and iterations. Records wall time, net allocated memory
+(end - start) and peak memory above the start of each phase, and exports them as a structured report
+
+Memory is measured by sampling the process resident set size (RSS) from a background thread while a phase is
+open. RSS peaks are sampled so short spikes between samples may be missed, and freed memory is not always
+returned to the OS so net RSS can overstate retained memory
+
+@options
+    profiler.interval = interval    # Seconds between RSS samples
+"""
+
+# Externals
+import os
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+
+def _rss():
+
+    """
+    :return: current resident set size of this process in bytes (peak RSS if /proc is unavailable)
+    """
+
+    try:
+        with open("/proc/self/statm","r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError,OSError,ValueError):
+        return _max_rss()
+
+
+def _max_rss():
+
+    """
+    :return: peak resident set size of this process in bytes
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] == "Darwin":	# Bytes on OS X, kilobytes elsewhere
+        return peak
+    return peak * 1024
+
+
+class MemoryProfiler(object):
+
+    """
+    Record memory and wall time of (nested) named phases, each optionally tagged with an iteration number
+    """
+
+    def __init__(self,interval=0.005):
+
+        self.interval = interval		# Seconds between RSS samples
+        self.records = []				# Record of each completed phase
+        self._stack = []				# Open phases (outermost first)
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._running = False
+
+    def start(self):
+
+        """
+        Start background RSS sampling
+
+        RSS is only sampled while a phase is open, so phase() starts and stops sampling itself
+        """
+
+        if self._running is True:
+            return
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+
+        """
+        Stop RSS sampling (records are kept)
+        """
+
+        self._running = False
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def current(self):
+
+        """
+        :return: current RSS in bytes
+        """
+
+        return _rss()
+
+    def _fold(self):
+
+        """
+        Fold current RSS into the peaks of all open phases (caller holds self._lock)
+        """
+
+        peak = _rss()
+        for frame in self._stack:
+            if peak > frame["peak"]:
+                frame["peak"] = peak
+
+    def _sample(self):
+
+        """
+        Background RSS sampling loop
+        """
+
+        while self._running is True:
+            time.sleep(self.interval)
+            with self._lock:
+                self._fold()
+
+    @contextmanager
+    def phase(self,name,iteration=None):
+
+        """
+        Context in which memory and wall time of phase name are recorded
+
+        :arg name : phase name
+        :arg (optional) iteration : iteration number (inherited from the enclosing phase if None)
+        """
+
+        self.start()
+        with self._lock:
+            self._fold()
+            if iteration is None and len(self._stack) > 0:
+                iteration = self._stack[-1]["iteration"]
+            start = self.current()
+            frame = {"phase":name,"iteration":iteration,"depth":len(self._stack),"start":start,"peak":start}
+            self._stack.append(frame)
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            t2 = time.time()
+            with self._lock:
+                self._fold()
+                end = self.current()
+                self._stack.remove(frame)
+            if len(self._stack) == 0:
+                self.stop()
+            self.records.append({"phase":name,"iteration":iteration,"depth":frame["depth"],"wall":t2-t1,
+                                 "start":frame["start"],"end":end,"net":end-frame["start"],
+                                 "peak":max(frame["peak"],end)-frame["start"]})
+
+    def summary(self):
+
+        """
+        :return: dictionary of phase name : calls, total wall time, total net and maximum peak memory
+        """
+
+        phases = {}
+        for record in self.records:
+            total = phases.setdefault(record["phase"],{"calls":0,"wall":0.0,"net":0,"peak":0})
+            total["calls"] += 1
+            total["wall"] += record["wall"]
+            total["net"] += record["net"]
+            total["peak"] = max(total["peak"],record["peak"])
+
+        return phases
+
+    def report(self):
+
+        """
+        :return: structured report dictionary (memory in bytes, wall time in seconds)
+        """
+
+        return {"backend":"rss","units":"bytes","process_peak_rss":_max_rss(),
+                "summary":self.summary(),"records":list(self.records)}
+
+    def write_report(self,filename):
+
+        """
+        Write report() to filename as JSON
+
+        :arg filename : path of JSON report
+        """
+
+        with open(filename,"w") as report_file:
+            json.dump(self.report(),report_file,indent=2,sort_keys=True)
+
+
+@contextmanager
+def _no_phase():
+
+    yield
+
+
+def profile_phase(owner,name,iteration=None):
+
+    """
+    :arg owner : clustering object with profile option and profiler
+    :arg name : phase name
+    :arg (optional) iteration : iteration number
+    :return: context recording phase name in owner.profiler (no-op if owner.profile is not True)
+    """
+
+    if owner.profile is not True or owner.profiler is None:
+        return _no_phase()
+    return owner.profiler.phase(name,iteration)
+
+
+def profiled(method):
+
+    """
+    Decorator recording each call of method as a phase of self.profiler if self.profile is True
+    (self.profiler is created on first use)
+    """
+
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if self.profile is not True:
+            return method(self,*args,**kwargs)
+        if self.profiler is None:
+            self.profiler = MemoryProfiler()
+        with self.profiler.phase(method.__name__):
+            return method(self,*args,**kwargs)
+
+    return wrapper
@@ -15,19 +15,454 @@ The algorithm determines the optimal distance D for final clustering based on op
     "lower" : sum of lower approximations - maximum entity uniqueness across all clusters at distance D
     "coverage" : total # of entites covered by all clusters - maximum number of entities across all clusters at distance D
     "ratio" : ratio of lower/coverage (default) - maximum ratio of unique entities to total entities across all clusters at distance D
-    "all" : return clusters at every distance D from [0 - self.total_entities]
+    "all" : return clusters at every distance D from [0 - self.maxD)
 
 @author Michael Tompkins
 @copyright 2016
 """
 
 # Externals
+import os
 import time
+import ctypes
+import hashlib
 import itertools
 import operator
-from collections import Counter
+import multiprocessing
+from collections import Mapping
+from multiprocessing.sharedctypes import RawArray
 import numpy as npy
-from copy import deepcopy
+
+# Package level imports
+from profiling import profiled, profile_phase
+from rough_metrics import rough_quality
+
+
+class _PairAssigner:
+
+    """
+    Assign candidate entity pairs (in order, over one or more calls to assign()) to rough clusters, optionally
+    continuing from existing clusters
+    """
+
+    def __init__(self,level=None,cluster_list=None,cluster_first=None):
+
+        """
+        :arg (optional) level : RoughClusterLevel of existing clusters to continue assigning pairs to
+        :arg (optional) cluster_list : entities of existing clusters (in order of assignment)
+        :arg (optional) cluster_first : first cluster assigned to each entity in cluster_list
+        """
+
+        if level is None:
+            self.clusters = []
+            self.cluster_list = []
+            self.first_cluster = {}
+        else:
+            self.clusters = [level.members(g).tolist() for g in range(len(level.indptr)-1)]
+            self.cluster_list = cluster_list.tolist()
+            self.first_cluster = dict(itertools.izip(self.cluster_list,cluster_first.tolist()))
+        self.members = [set(g) for g in self.clusters]
+
+    def assign(self,rows,cols):
+
+        """
+        :arg rows : first entity index of each candidate pair
+        :arg cols : second entity index of each candidate pair (equal to rows for duplicated entities)
+        """
+
+        clusters = self.clusters
+        members = self.members
+        cluster_list = self.cluster_list
+        first_cluster = self.first_cluster
+        for key1,key2 in itertools.izip(rows.tolist(),cols.tolist()):
+            first1 = first_cluster.get(key1)
+            first2 = first_cluster.get(key2)
+            if key1 == key2:								# Duplicated entity forms its own cluster if unassigned
+                if first1 is None:
+                    first_cluster[key1] = len(clusters)
+                    clusters.append([key1])
+                    members.append({key1})
+                    cluster_list.append(key1)
+            elif first1 is not None and first2 is not None:	# Assign each entity to other's first cluster
+                if key1 not in members[first2]:
+                    clusters[first2].append(key1)
+                    members[first2].add(key1)
+                if key2 not in members[first1]:
+                    clusters[first1].append(key2)
+                    members[first1].add(key2)
+            elif first1 is not None:						# Assign entity 2 to entity 1's first cluster
+                clusters[first1].append(key2)
+                members[first1].add(key2)
+                cluster_list.append(key2)
+                first_cluster[key2] = first1
+            elif first2 is not None:						# Assign entity 1 to entity 2's first cluster
+                clusters[first2].append(key1)
+                members[first2].add(key1)
+                cluster_list.append(key1)
+                first_cluster[key1] = first2
+            else:											# Assign both entities to new cluster list
+                first_cluster[key1] = len(clusters)
+                first_cluster[key2] = len(clusters)
+                clusters.append([key1,key2])
+                members.append({key1,key2})
+                cluster_list.append(key1)
+                cluster_list.append(key2)
+
+    def result(self):
+
+        """
+        :return clusters : list of entity index lists for each cluster
+        :return cluster_list : list of all entities in clusters (in order of assignment)
+        :return cluster_first : list of first cluster assigned to each entity in cluster_list
+        """
+
+        return self.clusters,self.cluster_list,[self.first_cluster[g] for g in self.cluster_list]
+
+
+def _assign_pairs(rows,cols,level=None,cluster_list=None,cluster_first=None):
+
+    """
+    Assign candidate entity pairs (in order) to rough clusters, optionally continuing from existing clusters
+
+    :arg rows : first entity index of each candidate pair
+    :arg cols : second entity index of each candidate pair (equal to rows for duplicated entities)
+    :arg (optional) level : RoughClusterLevel of existing clusters to continue assigning pairs to
+    :arg (optional) cluster_list : entities of existing clusters (in order of assignment)
+    :arg (optional) cluster_first : first cluster assigned to each entity in cluster_list
+    :return clusters, cluster_list, cluster_first (see _PairAssigner.result())
+    """
+
+    assigner = _PairAssigner(level,cluster_list,cluster_first)
+    assigner.assign(rows,cols)
+
+    return assigner.result()
+
+
+def _bincount_distances(hist,block_dists,row_weights=None,col_weights=None):
+
+    """
+    Add a block of inter-entity distances to their histogram
+
+    :arg hist : counts of each integer inter-entity distance so far
+    :arg block_dists : block of integer inter-entity distances
+    :arg (optional) row_weights, col_weights : multiplicities of block rows and columns if duplicates were collapsed
+    :return hist : updated counts of each integer inter-entity distance
+    """
+
+    if row_weights is None:
+        counts = npy.bincount(block_dists.ravel())
+    else:
+        counts = npy.bincount(block_dists.ravel(),weights=(row_weights[:,None] * col_weights[None,:]).ravel())
+        counts = npy.round(counts).astype(npy.int64)
+    if len(counts) > len(hist):
+        counts[0:len(hist)] += hist
+        return counts
+    hist[0:len(counts)] += counts
+
+    return hist
+
+
+class RoughClusterLevel(Mapping):
+
+    """
+    Rough clusters at a single distance D in compressed sparse row form: the entity indices of cluster c are
+    indices[indptr[c]:indptr[c+1]]. A subset of clusters (e.g. pruned clusters) is an index view over the same
+    arrays given by selection (sorted cluster ids), not a copy.
+
+    If duplicate entities were collapsed, indices refer to unique entities with multiplicity weights, and
+    groups maps each unique entity back to its original entities
+
+    Behaves as the legacy read-only dictionary of cluster id : list of entity keys, with each entity key list
+    built on access (to_dict() builds the entire dictionary)
+    """
+
+    def __init__(self,indptr,indices,total_entities,selection=None,weights=None,groups=None):
+
+        self.indptr = indptr					# Offset of each cluster's entities in indices
+        self.indices = indices					# Entity indices of all clusters
+        self.total_entities = total_entities	# Total number of entities to be clustered
+        self.selection = selection				# Sorted cluster ids in view (None for all clusters)
+        self.weights = weights					# Multiplicity of each unique entity (None if not collapsed)
+        self.groups = groups					# (indptr,entities) of original entities for each unique entity
+
+    @classmethod
+    def from_lists(cls,clusters,total_entities,weights=None,groups=None):
+
+        """
+        Pack list of entity index lists for each cluster into compressed sparse rows
+
+        :arg clusters : list of entity index lists for each cluster
+        :arg total_entities : total number of entities to be clustered
+        :arg (optional) weights : multiplicity of each unique entity if duplicates were collapsed
+        :arg (optional) groups : (indptr,entities) of original entities for each unique entity
+        :return RoughClusterLevel
+        """
+
+        indptr = npy.zeros(len(clusters)+1,dtype=npy.int64)
+        indptr[1:] = npy.cumsum([len(g) for g in clusters])
+        indices = npy.fromiter(itertools.chain(*clusters),dtype=npy.int32,count=indptr[-1])
+
+        return cls(indptr,indices,total_entities,weights=weights,groups=groups)
+
+    def cluster_ids(self):
+
+        """
+        :return: array of cluster ids in view
+        """
+
+        if self.selection is None:
+            return npy.arange(len(self.indptr)-1)
+        return self.selection
+
+    def sizes(self):
+
+        """
+        :return: array of upper approximation sizes (by weight) of clusters in view
+        """
+
+        if self.weights is None:
+            return npy.diff(self.indptr)[self.cluster_ids()]
+        return npy.add.reduceat(npy.append(self.weights[self.indices],0),self.indptr[:-1])[self.cluster_ids()] * \
+            (npy.diff(self.indptr)[self.cluster_ids()] > 0)
+
+    def members(self,key):
+
+        """
+        :arg key : cluster id
+        :return: array of entity indices for cluster (view)
+        """
+
+        return self.indices[self.indptr[key]:self.indptr[key+1]]
+
+    def entities(self,key):
+
+        """
+        :arg key : cluster id
+        :return: array of original entity indices for cluster (duplicate entities expanded)
+        """
+
+        if self.groups is None:
+            return self.members(key)
+        group_ptr,group_entities = self.groups
+        return npy.concatenate([group_entities[group_ptr[g]:group_ptr[g+1]] for g in self.members(key)])
+
+    def select(self,cluster_ids):
+
+        """
+        :arg cluster_ids : cluster ids to keep in view
+        :return: RoughClusterLevel view of given clusters over the same arrays
+        """
+
+        return RoughClusterLevel(self.indptr,self.indices,self.total_entities,npy.sort(cluster_ids),
+                                 self.weights,self.groups)
+
+    def approximation_sums(self):
+
+        """
+        Sum lower and upper approximations over all clusters in view (weighted by entity multiplicity)
+
+        The lower approximation of a cluster holds its entities that belong to no other cluster, so the
+        sum of lower approximations is the number of entities with exactly one cluster membership
+
+        :return sum_lower, sum_upper, number of entities covered
+        """
+
+        if self.selection is None:
+            entities = self.indices
+        elif len(self.selection) > 0:
+            entities = npy.concatenate([self.members(g) for g in self.selection])
+        else:
+            entities = npy.zeros(0,dtype=npy.int32)
+        if self.weights is None:
+            membership = npy.bincount(entities,minlength=self.total_entities)
+            return int(npy.sum(membership == 1)),int(npy.sum(membership)),int(npy.count_nonzero(membership))
+
+        membership = npy.bincount(entities,minlength=len(self.weights))
+        return int(npy.sum(self.weights[membership == 1])),int(npy.dot(membership,self.weights)),\
+            int(npy.sum(self.weights[membership > 0]))
+
+    def to_dict(self):
+
+        """
+        :return: legacy dictionary of cluster id : list of entity keys for all clusters in view
+        """
+
+        return {key : self[key] for key in self}
+
+    def __getitem__(self,key):
+
+        if key < 0 or key >= len(self.indptr)-1 or \
+                (self.selection is not None and key not in self.selection):
+            raise KeyError(key)
+        return [str(g) for g in self.entities(key)]
+
+    def __iter__(self):
+
+        return iter(self.cluster_ids().tolist())
+
+    def __len__(self):
+
+        return len(self.cluster_ids())
+
+
+def _prune_level(clusters,max_clusters):
+
+    """
+    Prune clusters at a single distance D to the N largest clusters for each N in max_clusters
+
+    :arg clusters : RoughClusterLevel of all clusters at distance D
+    :arg max_clusters : list of numbers of clusters to return
+    :return pruned : dictionary containing N clusters that maximize upper approximation and their statistics
+    """
+
+    pruned = {"cluster_num":{},"sum_lower":{},"sum_upper":{},"percent_covered":{},"cluster_list":{}}
+    sorted_clusters = npy.argsort(-clusters.sizes(),kind="mergesort")
+    for value in max_clusters:
+        clusters1 = clusters.select(sorted_clusters[0:value])
+        # Compute upper/lower approximations for pruned clusters
+        sum_lower1,sum_upper1,covered1 = clusters1.approximation_sums()
+
+        # Pack stats into output
+        pruned["cluster_list"][value] = clusters1
+        pruned["cluster_num"][value] = len(clusters1)
+        pruned["sum_lower"][value] = sum_lower1
+        pruned["sum_upper"][value] = sum_upper1
+        pruned["percent_covered"][value] = (covered1/float(clusters.total_entities))*100.0
+
+    return pruned
+
+
+def _cluster_level(pair_index,pair_dist,distance,total_entities,max_clusters=None,weights=None,groups=None):
+
+    """
+    Enumerate rough clusters at a single distance D from the near pairs of entities
+
+    :arg pair_index : (i,j) entity indices of near pairs
+    :arg pair_dist : inter-entity distance of near pairs
+    :arg distance : inter-entity distance D
+    :arg total_entities : total number of entities to be clustered
+    :arg (optional) max_clusters : if supplied also prune clusters to each N in max_clusters
+    :arg (optional) weights : multiplicity of each unique entity if duplicates were collapsed
+    :arg (optional) groups : (indptr,entities) of original entities for each unique entity
+    :return clusters, cluster_list, cluster_first, sum_lower, sum_upper, pruned (None if max_clusters not supplied)
+    """
+
+    # Find entity pairs that have distance <= D
+    candidates = pair_dist <= distance
+    clusters,cluster_list,cluster_first = _assign_pairs(pair_index[candidates,0],pair_index[candidates,1])
+    clusters = RoughClusterLevel.from_lists(clusters,total_entities,weights,groups)
+
+    # Determine upper and lower approximations of clusters for total clusters
+    sum_lower,sum_upper,_ = clusters.approximation_sums()
+
+    pruned = None
+    if max_clusters is not None:
+        pruned = _prune_level(clusters,max_clusters)
+
+    return clusters,npy.asarray(cluster_list,dtype=npy.int32),npy.asarray(cluster_first,dtype=npy.int32),\
+        sum_lower,sum_upper,pruned
+
+
+def _objective_value(pruned,objective):
+
+    """
+    Objective value of pruned clusters at a single distance D (compared across distances D by optimize_clusters())
+
+    :arg pruned : dictionary of pruned clusters and statistics for distance D (see _prune_level())
+    :arg objective : "lower", "coverage" or "ratio"
+    :return list of objective values for each number of clusters in max_clusters
+    """
+
+    if objective == "lower":
+        return [pruned["sum_lower"][g] for g in pruned["sum_lower"]]
+    elif objective == "coverage":
+        return [pruned["sum_upper"][g] for g in pruned["sum_upper"]]
+    else:
+        return [float(pruned["sum_lower"][g])/pruned["sum_upper"][g] for g in pruned["sum_upper"]]
+
+
+# Near pair arrays shared with worker processes
+_shared = {}
+
+
+def _init_worker(raw_index,raw_dist,total_entities,max_clusters,weights,groups):
+
+    """
+    Attach worker process to near pair arrays held in shared memory
+    """
+
+    _shared["pair_index"] = npy.frombuffer(raw_index,dtype=npy.int32).reshape(-1,2)
+    _shared["pair_dist"] = npy.frombuffer(raw_dist,dtype=npy.int32)
+    _shared["total_entities"] = total_entities
+    _shared["max_clusters"] = max_clusters
+    _shared["weights"] = weights
+    _shared["groups"] = groups
+
+
+def _cluster_level_worker(distance):
+
+    """
+    Enumerate and prune rough clusters at distance D in a worker process
+
+    Only the arrays of the clusters are returned, with the selection of each pruned view in place of the view, as
+    weights and groups are already held by the parent (see RoughCluster.enumerate_clusters_parallel())
+    """
+
+    clusters,cluster_list,cluster_first,sum_lower,sum_upper,pruned = \
+        _cluster_level(_shared["pair_index"],_shared["pair_dist"],distance,_shared["total_entities"],
+                       _shared["max_clusters"],_shared["weights"],_shared["groups"])
+    pruned["cluster_list"] = {value : view.selection for value,view in pruned["cluster_list"].items()}
+
+    return distance,clusters.indptr,clusters.indices,cluster_list,cluster_first,sum_lower,sum_upper,pruned
+
+
+def _objective_level_worker(args):
+
+    """
+    Compute objective value of pruned clusters at distance D in a worker process
+    """
+
+    distance,objective = args
+    pruned = _cluster_level(_shared["pair_index"],_shared["pair_dist"],distance,
+                            _shared["total_entities"],_shared["max_clusters"],
+                            _shared["weights"],_shared["groups"])[-1]
+
+    return distance,_objective_value(pruned,objective)
+
+
+def _histogram_percentile(hist,q):
+
+    """
+    Percentile of integer values from their histogram, interpolated as in numpy.percentile
+
+    :arg hist : counts of each integer value
+    :arg q : percentile in [0,100]
+    :return percentile value
+    """
+
+    cumulative = npy.cumsum(hist)
+    rank = (cumulative[-1] - 1) * q / 100.0
+    lower = npy.searchsorted(cumulative,npy.floor(rank),side="right")
+    upper = npy.searchsorted(cumulative,npy.ceil(rank),side="right")
+
+    return lower + (upper - lower) * (rank - npy.floor(rank))
+
+
+def _integer_features(array):
+
+    """
+    Check that entity features are complete integers, as inter-entity distances are counted in integer histograms
+
+    :arg array : (entities x features) array
+    :return array : unchanged
+    """
+
+    if array.dtype.kind not in "biu":
+        if array.dtype.kind == "f" and npy.isnan(array).any():
+            raise ValueError("RoughCluster requires complete integer features (found missing values)")
+        raise ValueError("RoughCluster requires integer features (found %s)" % array.dtype)
+
+    return array
 
 
 class RoughCluster:
@@ -36,16 +471,28 @@ class RoughCluster:
 
         # Rough set clustering output vars
         self.data = input_data
-        self.distance = {}
+        self.feature_names = None
+        self.data_array = None
+        self.weights = None
+        self.groups = None
+        self.unique_index = None
+        self.pair_recall = None
+        self.distance_store = None
+        self.dist_hist = None
+        self.pair_index = None
+        self.pair_dist = None
         self.all_keys = {}
         self.clusters = []
         self.sum_upper = []
         self.sum_lower = []
         self.cluster_list = []
+        self.cluster_first = []
         self.total_entities = 0
         self.pruned = {}
         self.optimal = {}
         self.opt_d = None
+        self.objective_values = {}
+        self.quality = {}
 
         self.debug = False
         self.small = 1.0e-10
@@ -55,14 +502,55 @@ class RoughCluster:
         self.maxD = max_d					# Maximum inter-entity distance to perform clustering over
         self.objective = objective			# Objective to maximize for optimal clustering distance D
         self.max_clusters = [max_clusters]	# Number of clusters to return
+        self.block_size = 512				# Number of entities per block in distance computations
+        self.sample_size = None				# Number of sampled entities to estimate minD/maxD (None for all)
+        self.n_jobs = 1						# Number of worker processes for enumerating distances D
+        self.collapse_duplicates = False	# Option (True) to cluster unique entities weighted by multiplicity
+        self.approximate = False			# Option (True) to find near pairs by locality-sensitive hashing
+        self.lsh_tables = 8					# Number of hash tables for approximate near pairs
+        self.lsh_features = 4				# Number of randomly chosen features hashed per table (None for all)
+        self.lsh_width = 2.0				# Hash cell width of each feature (as multiple of its share of maxD+1)
+        self.lsh_bucket = 256				# Number of entities of a hash cell each entity is compared with
+        self.lsh_sample = 1000				# Number of sampled entities to estimate recall of approximate near pairs
+        self.distance_file = None			# Path of memory-mapped distance matrix (None keeps near pairs in memory)
+        self.memory_budget = 2**28			# Bytes of distances computed or read at once (histogram, distance_file)
+        self.profile = False				# Option (True) to record memory of phases and distances D
+        self.profiler = None				# MemoryProfiler of recorded phases (if profile)
+        self.quality_sample = 500			# Number of sampled entities for silhouette quality (None to skip)
 
+    @profiled
     def get_entity_distances(self):
 
         """
-        Compute inter-entity distance matrix for all unique entities in input
+        Compute inter-entity distances for all pairs of entities within distance maxD of each other
+
+        Only near pairs are kept, as a sparse edge list sorted by entity index, so memory scales with
+        the number of pairs within maxD rather than with all n^2 pairs
+
+        If self.approximate is True, near pairs are found by locality-sensitive hashing (see get_approximate_pairs())
+        and distance percentiles are estimated from self.lsh_sample entities unless self.sample_size is set
+
+        If self.distance_file is set, the full distance matrix is written to (or reused from) that file instead
+        and near pairs are streamed from it by enumerate_clusters() (see write_distance_file())
+
+        If self.collapse_duplicates is True, identical entities are collapsed to a single unique entity with
+        a multiplicity weight, and a unique entity occurring more than once is paired with itself at distance 0
+
+        Features must be complete integer columns (ValueError otherwise, e.g. for missing values loaded as NaN)
 
         :var self.data
-        :return: self.distance : inter-entity distances for all unique (lower traingular) pairs of entities
+        :var self.sample_size
+        :var self.collapse_duplicates
+        :var self.approximate
+        :var self.distance_file
+        :return: self.data_array : features of all (unique) entities
+        :return: self.weights : multiplicity of each unique entity (if collapse_duplicates)
+        :return: self.groups : (indptr,entities) of original entities for each unique entity (if collapse_duplicates)
+        :return: self.unique_index : unique entity of each original entity (if collapse_duplicates)
+        :return: self.dist_hist : histogram of all inter-entity distances
+        :return: self.pair_index : (i,j) entity indices (i < j) for all pairs with distance <= maxD
+        :return: self.pair_dist : inter-entity distance for each pair in self.pair_index
+        :return: self.pair_recall : estimated fraction of near pairs found (if approximate)
         :return self.all_keys
         :return self.total_entities
         :return self.minD
@@ -70,220 +558,838 @@ class RoughCluster:
         """
 
         header = self.data.keys()
-        data_length = len(self.data[header[0]])
+        self.feature_names = header
+        self.data_array = _integer_features(npy.asarray([self.data[val] for val in header]).T)
+        data_length = self.data_array.shape[0]
 
         t1 = time.time()
 
-        # Enumerate entire distance matrix
-        for k in range(0,data_length):
-            self.distance[str(k)] = {str(j): sum([abs(self.data[val][k]-self.data[val][j]) for val in header])
-                                        for j in range(0,data_length)}
+        self.all_keys = {str(key): None for key in range(0,data_length)}    # Static all entity keys
+        self.total_entities = data_length
+
+        if self.collapse_duplicates is True:
+            # Keep unique entities in order of first occurrence, as pairs are assigned to clusters in entity order
+            unique,first,inverse,counts = npy.unique(self.data_array,axis=0,return_index=True,return_inverse=True,
+                                                     return_counts=True)
+            order = npy.argsort(first)
+            rank = npy.empty_like(order)
+            rank[order] = npy.arange(len(order))
+            self.data_array = unique[order]
+            self.unique_index = rank[inverse]
+            self.weights = counts[order]
+            group_ptr = npy.zeros(len(self.weights)+1,dtype=npy.int64)
+            group_ptr[1:] = npy.cumsum(self.weights)
+            self.groups = (group_ptr,npy.argsort(self.unique_index,kind="mergesort").astype(npy.int32))
 
-        curr_dists = list(itertools.chain([self.distance[h][g] for h in self.distance for g in self.distance[h]]))
-        self.minD = int(max([npy.percentile(curr_dists,2),2]))
+        # Distance statistics over entire distance matrix
+        if self.distance_file is not None:
+            self.write_distance_file()
+        else:
+            self.get_distance_histogram()
+        self.minD = int(max([_histogram_percentile(self.dist_hist,2),2]))
         if self.maxD is None:   # Determine maxD based on 25th percentile of all inter-cluster distances
-            self.maxD = int(max([npy.percentile(curr_dists,25),3]))
+            self.maxD = int(max([_histogram_percentile(self.dist_hist,25),3]))
 
-        self.all_keys = {str(key): None for key in range(0,data_length)}    # Static all entity keys
-        curr_keys = {str(key): None for key in range(0,data_length)}		# Place holder entity keys
-        self.total_entities = len(curr_keys.keys())
+        if self.distance_file is not None:
+            if self.debug is True:
+                print "Total Entities to Cluster:", self.total_entities
+                print "Max Intra-Entity Distance to Cluster:",self.maxD
+                print "Min Intra-Entity Distance to Cluster:",self.minD
+                print "Distance Matrix File:",self.distance_file
+            return
 
-        # Compute distance of all pairs (p,q) where p != q
-        for k in range(0,data_length):
-            key1 = str(k)
-            curr_keys.pop(key1)
-            #self.distance[key1] = {key2 : int(sum([abs(self.data[val][k]-self.data[val][int(key2)]) for val in header]))
-            #					   for key2 in curr_keys.keys()}
-            self.distance[key1] = {key2 : int(self.distance[key1][key2]) for key2 in curr_keys.keys()}
+        # Collect distance of all pairs (p,q) where p < q and distance <= maxD
+        rows = [npy.zeros(0,dtype=npy.int64)]
+        cols = [npy.zeros(0,dtype=npy.int64)]
+        dists = [npy.zeros(0,dtype=npy.int64)]
+        if self.weights is not None:	# Pair duplicated entities with themselves
+            duplicated = npy.nonzero(self.weights > 1)[0]
+            rows.append(duplicated)
+            cols.append(duplicated)
+            dists.append(npy.zeros(len(duplicated),dtype=npy.int64))
+        if self.approximate is True:
+            candidate_pairs = self.get_approximate_pairs(self.maxD)
+        else:
+            candidate_pairs = self.get_candidate_pairs(self.maxD)
+        for row,col,dist in candidate_pairs:
+            rows.append(row)
+            cols.append(col)
+            dists.append(dist)
+        rows = npy.concatenate(rows)
+        cols = npy.concatenate(cols)
+        order = self.get_pair_order(rows,cols)
+        self.pair_index = npy.column_stack((rows[order],cols[order])).astype(npy.int32)
+        self.pair_dist = npy.concatenate(dists)[order].astype(npy.int32)
 
         t2 = time.time()
         if self.debug is True:
             print "time",t2-t1
             print "Total Entities to Cluster:", self.total_entities
+            print "Unique Entities to Cluster:", self.data_array.shape[0]
             print "Input Feature Length",len(header)
             print "Max Intra-Entity Distance to Cluster:",self.maxD
             print "Min Intra-Entity Distance to Cluster:",self.minD
+            print "Candidate Pairs within Max Distance:",len(self.pair_dist)
+            if self.approximate is True:
+                print "Estimated Recall of Candidate Pairs:",self.pair_recall
+
+        return
+
+    def get_pair_order(self,rows,cols):
+
+        """
+        Order in which near pairs are assigned to clusters: by first entity, then by second entity
+
+        If duplicates were collapsed, each pair of unique entities is placed where the first pair of original
+        entities it stands for would be: by first occurrence of each entity, with the self pair of a duplicated
+        entity at the second occurrence of that entity. Collapsed clusters are then those of the original entities
+
+        :arg rows : first (unique) entity index of each pair
+        :arg cols : second (unique) entity index of each pair (equal to rows for duplicated entities)
+        :var self.groups
+        :return: array of pair indices in assignment order
+        """
+
+        if self.groups is None:
+            return npy.lexsort((cols,rows))
+        group_ptr,group_entities = self.groups
+        col_keys = group_entities[group_ptr[cols] + (rows == cols)]
+
+        return npy.lexsort((col_keys,rows))
+
+    @profiled
+    def get_distance_histogram(self):
+
+        """
+        Accumulate histogram of all inter-entity distances (full distance matrix) block by block, or of the
+        distances from self.sample_size randomly sampled entities to all entities if sample_size is set. Blocks
+        are sized so that their distances take no more than about self.memory_budget bytes (see get_block_rows())
+
+        Distances between unique entities are counted by the product of their multiplicities, so the histogram
+        is that of the original entities when duplicates are collapsed
+
+        :var self.data_array
+        :var self.weights
+        :var self.memory_budget
+        :var self.sample_size
+        :return: self.dist_hist : counts of each integer inter-entity distance
+        """
+
+        data_length = self.total_entities
+        sample_size = self.sample_size
+        if sample_size is None and self.approximate is True:
+            sample_size = self.lsh_sample
+        if sample_size is not None and sample_size < data_length:
+            rows = npy.sort(npy.random.choice(data_length,sample_size,replace=False))
+        else:
+            rows = npy.arange(data_length)
+        row_weights = None
+        if self.weights is not None:	# Sampled entities map to unique entities
+            rows,row_weights = npy.unique(self.unique_index[rows],return_counts=True)
+
+        self.dist_hist = npy.zeros(1,dtype=npy.int64)
+        block_rows = self.get_block_rows(self.data_array.shape[0])
+        for k in range(0,len(rows),block_rows):
+            self.dist_hist = _bincount_distances(self.dist_hist,self.get_block_distances(rows[k:k+block_rows]),
+                                                 None if row_weights is None else row_weights[k:k+block_rows],
+                                                 self.weights)
 
         return
 
+    @profiled
+    def write_distance_file(self):
+
+        """
+        Write the full inter-entity distance matrix to self.distance_file block by block, in the smallest unsigned
+        integer type that holds all distances, accumulating the distance histogram as blocks are computed. The
+        histogram and a fingerprint of the input are saved alongside (self.distance_file + ".meta.npz"), and an
+        existing file with the same fingerprint is reused without computing any distances, so several runs with
+        different max_clusters or objective share one distance matrix
+
+        The metadata is removed before the matrix is rewritten and saved only once the matrix is complete, so an
+        interrupted rewrite is recomputed rather than reused
+
+        Blocks of rows are sized so that the distances of a block and their temporaries (about four int64 arrays
+        of block rows x entities) take no more than about self.memory_budget bytes
+
+        :var self.data_array
+        :var self.weights
+        :var self.distance_file
+        :var self.memory_budget
+        :return: self.distance_store : read-only memory map of the distance matrix
+        :return: self.dist_hist : counts of each integer inter-entity distance
+        """
+
+        data_length = self.data_array.shape[0]
+        fingerprint = hashlib.sha1(npy.ascontiguousarray(self.data_array).tobytes())
+        if self.weights is not None:
+            fingerprint.update(npy.ascontiguousarray(self.weights).tobytes())
+        fingerprint = fingerprint.hexdigest()
+        meta_file = self.distance_file + ".meta.npz"
+
+        if os.path.exists(self.distance_file) and os.path.exists(meta_file):
+            meta = npy.load(meta_file)
+            try:
+                reuse = str(meta["fingerprint"]) == fingerprint
+                if reuse is True:
+                    self.dist_hist = meta["hist"]
+            finally:
+                meta.close()
+            if reuse is True:
+                self.distance_store = npy.lib.format.open_memmap(self.distance_file,mode="r")
+                return
+
+        # Remove metadata before rewriting, so an interrupted rewrite is never reused
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+
+        max_dist = int(npy.sum(npy.max(self.data_array,axis=0) - npy.min(self.data_array,axis=0)))
+        dtype = [t for t in (npy.uint8,npy.uint16,npy.uint32,npy.int64) if max_dist <= npy.iinfo(t).max][0]
+        store = npy.lib.format.open_memmap(self.distance_file,mode="w+",dtype=dtype,shape=(data_length,data_length))
+        self.dist_hist = npy.zeros(1,dtype=npy.int64)
+        block_rows = self.get_block_rows(data_length)
+        for k in range(0,data_length,block_rows):
+            block_dists = self.get_block_distances(slice(k,k+block_rows))
+            store[k:k+block_rows] = block_dists
+            self.dist_hist = _bincount_distances(self.dist_hist,block_dists,
+                                                 None if self.weights is None else self.weights[k:k+block_rows],
+                                                 self.weights)
+            del block_dists
+        store.flush()
+        del store
+        # Metadata is written last (and renamed into place), marking the distance matrix complete
+        temp_file = meta_file + ".tmp"
+        with open(temp_file,"wb") as meta:
+            npy.savez(meta,hist=self.dist_hist,fingerprint=fingerprint)
+        os.rename(temp_file,meta_file)
+        self.distance_store = npy.lib.format.open_memmap(self.distance_file,mode="r")
+
+        return
+
+    def get_distance_tiles(self,max_d):
+
+        """
+        Stream pairs of entities with inter-entity distance <= max_d from self.distance_store in tiles of rows, with
+        no more than about self.memory_budget bytes of the distance matrix resident at once
+
+        :arg max_d : maximum inter-entity distance of returned pairs
+        :var self.distance_store
+        :var self.memory_budget
+        :return: generator of (rows,cols,dists) arrays for tiles of pairs where rows < cols, in entity index order
+        """
+
+        data_length = self.distance_store.shape[0]
+        tile_rows = max(1,int(self.memory_budget // (data_length * (self.distance_store.dtype.itemsize + 1))))
+        columns = npy.arange(data_length)
+        for k in range(0,data_length,tile_rows):
+            tile = npy.asarray(self.distance_store[k:k+tile_rows])
+            rows = npy.arange(k,k+len(tile))
+            near = columns[None,:] > rows[:,None]
+            if self.weights is not None:	# Pair duplicated entities with themselves
+                near[rows-k,rows] = self.weights[rows] > 1
+            near &= tile <= max_d
+            row,col = npy.nonzero(near)
+            dist = tile[row,col]
+            row += k
+            if self.weights is not None:
+                order = self.get_pair_order(row,col)
+                row,col,dist = row[order],col[order],dist[order]
+            yield row,col,dist
+
+    def get_block_distances(self,rows,cols=None):
+
+        """
+        Compute inter-entity distances between a block of entities and a set of other entities
+
+        :arg rows : entity indices (or slice) of block
+        :arg (optional) cols : entity indices (or slice) to compute distances to (default all entities)
+        :var self.data_array
+        :return: len(rows) x len(cols) array of integer inter-entity distances
+        """
+
+        block = self.data_array[rows]
+        other = self.data_array if cols is None else self.data_array[cols]
+        dist = npy.zeros((len(block),len(other)),dtype=npy.result_type(self.data_array,npy.int64))
+        for f in range(self.data_array.shape[1]):
+            dist += npy.abs(block[:,f][:,None] - other[:,f][None,:])
+
+        return dist.astype(npy.int64,copy=False)
+
+    def get_block_rows(self,num_cols):
+
+        """
+        :arg num_cols : number of entities each block entity is compared with
+        :var self.memory_budget
+        :return: number of block entities whose distances and temporaries (about four int64 arrays of block
+            entities x num_cols) take no more than about self.memory_budget bytes
+        """
+
+        return max(1,int(self.memory_budget // (max(num_cols,1) * 4 * npy.dtype(npy.int64).itemsize)))
+
+    def get_candidate_pairs(self,max_d):
+
+        """
+        Generate all pairs of entities with inter-entity distance <= max_d, without forming the full
+        distance matrix
+
+        Entities are sorted by a signed sum of their features. For any sign vector w, |w.(p-q)| is a lower
+        bound on the absolute distance between p and q, so only entities within max_d of each other in
+        this sorted projection need to be compared. Signs are taken from the leading principal axis of
+        the features to spread the projection as widely as possible.
+
+        Each block of self.block_size entities is compared with its projection window in chunks sized by
+        self.memory_budget (see get_block_rows()), so memory stays bounded when the window spans most entities
+
+        :arg max_d : maximum inter-entity distance of returned pairs
+        :var self.data_array
+        :var self.block_size
+        :var self.memory_budget
+        :return: generator of (rows,cols,dists) arrays for blocks of pairs where rows < cols
+        """
+
+        data_length = self.data_array.shape[0]
+        signs = npy.ones(self.data_array.shape[1])
+        if data_length > 1 and self.data_array.shape[1] > 1:
+            axes = npy.linalg.eigh(npy.atleast_2d(npy.cov(self.data_array.T)))[1]
+            signs = npy.where(axes[:,-1] < 0,-1.0,1.0)
+        projection = npy.dot(self.data_array,signs)
+        order = npy.argsort(projection,kind="mergesort")
+        sorted_projection = projection[order]
+        stop = npy.searchsorted(sorted_projection,sorted_projection + max_d + 1,side="left")
+
+        for k in range(0,data_length,self.block_size):
+            block = order[k:k+self.block_size]
+            last = int(stop[min(k+self.block_size,data_length)-1])
+            # Compare the block with its projection window in chunks, as the window of dense data can span all entities
+            window_size = self.get_block_rows(len(block))
+            for w in range(k+1,last,window_size):
+                window = order[w:min(w+window_size,last)]
+                # Only keep pairs ahead of each entity in projection order and inside its projection window
+                position = npy.arange(w,w+len(window))
+                valid = (position[None,:] > npy.arange(k,k+len(block))[:,None]) & \
+                        (position[None,:] < stop[k:k+len(block)][:,None])
+                block_dists = self.get_block_distances(block,window)
+                hits = npy.nonzero(valid & (block_dists <= max_d))
+                if len(hits[0]) == 0:
+                    continue
+                row = block[hits[0]]
+                col = window[hits[1]]
+                yield npy.minimum(row,col),npy.maximum(row,col),block_dists[hits]
+
+    def get_approximate_pairs(self,max_d):
+
+        """
+        Generate pairs of entities with inter-entity distance <= max_d by locality-sensitive hashing, with
+        time and memory bounded by self.lsh_tables * self.lsh_bucket candidate pairs per entity rather than all
+        n^2 pairs
+
+        Each of self.lsh_tables hash tables hashes entities to cells of a randomly shifted grid over a random subset
+        of self.lsh_features features. The cell width of each feature is w_f = self.lsh_width*(max_d+1)*s_f/sum(s),
+        where s_f is the mean absolute difference of feature f between sampled entities, so a feature's width is its
+        expected share of distance max_d. Two entities whose hashed feature differences are d_f fall in the same cell
+        with probability >= prod(1 - d_f/w_f). Recall therefore rises with more tables, wider cells or fewer hashed
+        features, at the cost of more candidate pairs to verify.
+
+        Entities of a cell are ordered by a random signed sum of their features (a lower bound on their distance),
+        and each entity is compared with the next self.lsh_bucket-1 entities of its cell only, so all pairs of
+        small cells are compared and pairs of oversized cells are limited to those nearest in this order.
+        Candidate pairs are verified exactly as they are generated, and only near pairs are kept
+
+        Recall of returned pairs is estimated against exact near pairs of self.lsh_sample sampled entities
+
+        :arg max_d : maximum inter-entity distance of returned pairs
+        :var self.data_array
+        :var self.lsh_tables
+        :var self.lsh_features
+        :var self.lsh_width
+        :var self.lsh_bucket
+        :var self.lsh_sample
+        :return: generator of (rows,cols,dists) arrays for blocks of pairs where rows < cols
+        :return: self.pair_recall : estimated fraction of near pairs found
+        """
+
+        data_length,num_features = self.data_array.shape
+        sample = npy.random.choice(data_length,min(self.lsh_sample,data_length),replace=False)
+        spread = npy.mean(npy.abs(self.data_array[sample] - self.data_array[npy.random.permutation(sample)]),axis=0)
+        spread = spread + self.small
+        widths = self.lsh_width * (max_d + 1) * spread / npy.sum(spread)
+        num_hashed = num_features if self.lsh_features is None else min(self.lsh_features,num_features)
+        chunk = self.block_size * self.block_size
+
+        # Collect distinct near pairs over all hash tables as keys row*n+col
+        pair_keys = npy.zeros(0,dtype=npy.int64)
+        pair_dists = npy.zeros(0,dtype=npy.int64)
+        for t in range(self.lsh_tables):
+            features = npy.random.choice(num_features,num_hashed,replace=False)
+            shift = npy.random.uniform(0,widths[features])
+            cells = npy.floor((self.data_array[:,features] + shift) / widths[features]).astype(npy.int64)
+            buckets = npy.unique(cells,axis=0,return_inverse=True)[1]
+            projection = npy.dot(self.data_array,npy.random.choice([-1.0,1.0],num_features))
+            order = npy.lexsort((projection,buckets))
+            sorted_buckets = buckets[order]
+            sorted_array = self.data_array[order]
+            keys = [pair_keys]
+            dists = [pair_dists]
+            for offset in range(1,min(self.lsh_bucket,data_length)):
+                if not npy.any(sorted_buckets[offset:] == sorted_buckets[:-offset]):
+                    break
+                # Compare entities offset apart in cell order, in chunks of contiguous rows
+                for k in range(0,data_length-offset,chunk):
+                    stop = min(k+chunk,data_length-offset)
+                    dist = npy.abs(sorted_array[k+offset:stop+offset] - sorted_array[k:stop]).sum(axis=1)
+                    near = npy.flatnonzero((dist <= max_d) & (sorted_buckets[k+offset:stop+offset] ==
+                                                              sorted_buckets[k:stop])) + k
+                    row = order[near]
+                    col = order[near + offset]
+                    keys.append(npy.minimum(row,col).astype(npy.int64) * data_length + npy.maximum(row,col))
+                    dists.append(dist[near - k].astype(npy.int64))
+            pair_keys,first = npy.unique(npy.concatenate(keys),return_index=True)
+            pair_dists = npy.concatenate(dists)[first]
+
+        for k in range(0,len(pair_keys),chunk):
+            yield pair_keys[k:k+chunk] // data_length,pair_keys[k:k+chunk] % data_length,pair_dists[k:k+chunk]
+
+        # Estimate recall from exact near pairs of sampled entities
+        exact = 0
+        matched = 0
+        block_rows = self.get_block_rows(data_length)
+        for k in range(0,len(sample),block_rows):
+            block = sample[k:k+block_rows]
+            row,col = npy.nonzero(self.get_block_distances(block) <= max_d)
+            row = block[row]
+            keep = row != col
+            keys = npy.minimum(row[keep],col[keep]).astype(npy.int64) * data_length + npy.maximum(row[keep],col[keep])
+            exact += len(keys)
+            matched += npy.count_nonzero(npy.in1d(keys,pair_keys))
+        self.pair_recall = matched / float(exact) if exact > 0 else 1.0
+
+    @profiled
     def enumerate_clusters(self):
 
         """
-        Method to enumerate rough clusters given distance measure between all pairs of input entities
+        Method to enumerate rough clusters given distance measure between all near pairs of input entities
+
+        If self.n_jobs > 1, distances D are enumerated (and pruned) in parallel by a pool of worker processes
+        sharing the near pair arrays. If distances are stored in self.distance_file, all distances D are instead
+        enumerated together in one pass over the file
 
-        :var self.distance
-        :var self.all_keys
+        :var self.pair_index
+        :var self.pair_dist
+        :var self.n_jobs
         :return : self.sum_lower - lower approximation for each cluster at each distance D
         :return : self.sum_upper - upper approximation for each cluster at each distance D
-        :return : self.cluster_list - list of all entities in clusters at each distance D
-        :return : self.clusters - list of clusters at each distance D
+        :return : self.cluster_list - array of all entities in clusters (in order of assignment) at each distance D
+        :return : self.cluster_first - array of first cluster of each entity in self.cluster_list at each distance D
+        :return : self.clusters - list of clusters (RoughClusterLevel) at each distance D
+        :return : self.pruned - pruned clusters at each distance D (if self.n_jobs > 1)
         """
 
-        # Loop over inter-entity distance D from 0:maxD and find candidate pairs with distance < i
-        for i in range(0,self.maxD):
-            ct2 = 0
-            cluster_count = 0
-            cluster_list = []
-            clusters = {}
-            first_cluster = {}
-            # Find entity pairs that have distance <= i
-            candidates = {key1:[key2 for key2 in self.distance[key1].keys() if self.distance[key1][key2] <= i ]
-                          for key1 in self.all_keys}
-            if self.debug is True:
-                print "# Candidate Pairs",i,len(list(itertools.chain(*[candidates[g] for g in candidates.keys()]))) #,max(candidates),min(candidates),npy.mean(candidates)
-            # Determine for all pairs if pairs are to be assigned to new clusters or previous clusters
-            for k,keyname in enumerate(candidates.keys()):
-                for l,keyname2 in enumerate(candidates[keyname]):
-                    if (keyname in cluster_list) and (keyname2 in cluster_list):	# Assign each entity to other's first cluster
-                        if keyname not in clusters[first_cluster[keyname2]]:
-                            clusters[first_cluster[keyname2]].append(keyname)
-                        if keyname2 not in clusters[first_cluster[keyname]]:
-                            clusters[first_cluster[keyname]].append(keyname2)
-                            ct2 += 1
-                    elif (keyname in cluster_list) and (keyname2 not in cluster_list):	# Assign entity 2 to entity 1's first cluster
-                        clusters[first_cluster[keyname]].append(keyname2)
-                        cluster_list.append(keyname2)
-                        first_cluster[keyname2] = first_cluster[keyname]
-                    elif keyname2 in cluster_list and (keyname not in cluster_list):	# Assign entity 1 to entity 2's first cluster
-                        clusters[first_cluster[keyname2]].append(keyname)
-                        cluster_list.append(keyname)
-                        first_cluster[keyname] = first_cluster[keyname2]
-                    else:														# Assign both entities to new cluster list
-                        clusters[cluster_count] = [keyname,keyname2]
-                        cluster_list.append(keyname)
-                        cluster_list.append(keyname2)
-                        first_cluster[keyname] = cluster_count					# Keep track of current cluster for each key
-                        first_cluster[keyname2] = cluster_count					# Keep track of current cluster for each key
-                        cluster_count += 1
+        # Levels enumerated together (from file or by the worker pool) are profiled as one phase, not per distance D
+        levels = None
+        if self.distance_store is not None:
+            levels = iter(self.enumerate_clusters_from_file(range(0,self.maxD)))
+        elif self.n_jobs > 1 and self.maxD > 1:
+            levels = iter(self.enumerate_clusters_parallel())
 
-            if self.debug is True:
-                print "Number of Clusters for maxD: ",i," : ",cluster_count
-
-            # Determine upper and lower approximations of clusters for total clusters and pruned clusters
-            sum_all = len(list(itertools.chain(*[clusters[g] for g in clusters.keys() if clusters])))
-            sum_lower = 0
-            sum_upper = 0
-            intersections = {}
-            int_tmp = {}
-            if len(clusters.keys()) > 1:
-                for key1 in clusters:
-                    intersections[key1] = {key2 : list(set(clusters[key1]).intersection(set(clusters[key2])))
-                                     for key2 in clusters if key2 != key1}
-                    int_tmp[key1] = len(clusters[key1]) - len(Counter(list(itertools.chain(*[intersections[key1][g]
-                                    for g in intersections[key1]]))))
-                    sum_lower += int_tmp[key1] #intersections[key1])
-                    sum_upper += len(clusters[key1])
+        # Loop over inter-entity distance D from 0:maxD and find candidate pairs with distance <= i
+        for i in range(0,self.maxD):
+            if levels is None:
+                with profile_phase(self,"cluster_level",i):
+                    level = _cluster_level(self.pair_index,self.pair_dist,i,self.total_entities,None,self.weights,
+                                           self.groups)
             else:
-                sum_lower = sum_all
-                sum_upper = sum_all
+                level = next(levels)
+            clusters,cluster_list,cluster_first,sum_lower,sum_upper,pruned = level
+            if self.debug is True:
+                print "Number of Clusters for maxD: ",i," : ",len(clusters)
 
             self.sum_lower.append(sum_lower)
             self.sum_upper.append(sum_upper)
             self.cluster_list.append(cluster_list)
+            self.cluster_first.append(cluster_first)
             self.clusters.append(clusters)
+            if pruned is not None:
+                self.pruned[i] = pruned
 
         return
 
+    def enumerate_clusters_from_file(self,distances):
+
+        """
+        Enumerate rough clusters for several distances D in a single streaming pass over self.distance_store
+
+        Only the tiles of the distance matrix are bounded by self.memory_budget. The clusters of all distances D are
+        built together as Python lists and sets, which grow with the number of distances D times the entities
+        (and pair memberships) of their clusters and are not covered by the budget
+
+        :arg distances : list of inter-entity distances D
+        :var self.distance_store
+        :return : generator of (clusters, cluster_list, cluster_first, sum_lower, sum_upper, None) for each distance D
+        """
+
+        if len(distances) == 0:
+            return
+        assigners = [_PairAssigner() for i in distances]
+        for row,col,dist in self.get_distance_tiles(max(distances)):
+            for i,assigner in itertools.izip(distances,assigners):
+                candidates = dist <= i
+                assigner.assign(row[candidates],col[candidates])
+
+        while len(assigners) > 0:
+            clusters,cluster_list,cluster_first = assigners.pop(0).result()
+            clusters = RoughClusterLevel.from_lists(clusters,self.total_entities,self.weights,self.groups)
+            sum_lower,sum_upper,_ = clusters.approximation_sums()
+            yield clusters,npy.asarray(cluster_list,dtype=npy.int32),npy.asarray(cluster_first,dtype=npy.int32),\
+                sum_lower,sum_upper,None
+
+    @profiled
+    def enumerate_clusters_parallel(self):
+
+        """
+        Enumerate and prune rough clusters for all distances D across self.n_jobs worker processes
+
+        Near pair arrays, weights and groups are passed once to all workers, and each worker returns the cluster
+        arrays, approximation sums and pruned selections for one distance D at a time, from which clusters are
+        rebuilt over self.weights and self.groups
+
+        :var self.pair_index
+        :var self.pair_dist
+        :var self.weights
+        :var self.groups
+        :var self.n_jobs
+        :return : list of (clusters, cluster_list, cluster_first, sum_lower, sum_upper, pruned) for each distance D
+        """
+
+        pool = self.get_worker_pool(self.maxD)
+        try:
+            # Largest distances have the most pairs so are dispatched first
+            levels = {}
+            for distance,indptr,indices,cluster_list,cluster_first,sum_lower,sum_upper,pruned in \
+                    pool.imap_unordered(_cluster_level_worker,range(self.maxD-1,-1,-1)):
+                clusters = RoughClusterLevel(indptr,indices,self.total_entities,weights=self.weights,
+                                             groups=self.groups)
+                pruned["cluster_list"] = {value : clusters.select(selection)
+                                          for value,selection in pruned["cluster_list"].items()}
+                levels[distance] = (clusters,cluster_list,cluster_first,sum_lower,sum_upper,pruned)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [levels[i] for i in range(0,self.maxD)]
+
+    def get_worker_pool(self,num_tasks):
+
+        """
+        Copy near pair arrays into shared memory and start a pool of worker processes attached to them
+
+        :arg num_tasks : number of tasks to be run (pool is no larger than this)
+        :var self.pair_index
+        :var self.pair_dist
+        :var self.n_jobs
+        :return: multiprocessing pool (caller closes)
+        """
+
+        raw_index = RawArray(ctypes.c_int32,self.pair_index.size)
+        raw_dist = RawArray(ctypes.c_int32,self.pair_dist.size)
+        npy.frombuffer(raw_index,dtype=npy.int32)[:] = self.pair_index.ravel()
+        npy.frombuffer(raw_dist,dtype=npy.int32)[:] = self.pair_dist
+
+        return multiprocessing.Pool(min(self.n_jobs,num_tasks),_init_worker,
+                                    (raw_index,raw_dist,self.total_entities,self.max_clusters,
+                                     self.weights,self.groups))
+
+    @profiled
     def optimize_clusters(self):
 
         """
         Maximize objective over all distances D [self.minD : self.maxD] to determine optimal distance clustering
 
+        For objective "all" clusters of every distance D are kept, and opt_d is the largest distance D enumerated
+
         :var self.pruned
         :var self.minD
         :var self.maxD
         :return: self.opt_d : optimal integer distance D
         """
 
-        if self.objective == "lower":
-            lst = {h : list(itertools.chain([self.pruned[h]["sum_lower"][g] for g in self.pruned[h]["sum_lower"]]))
-                   for h in self.pruned if int(h) >= self.minD}
+        if self.objective in ("lower","coverage","ratio"):
+            lst = {h : _objective_value(self.pruned[h],self.objective) for h in self.pruned if int(h) >= self.minD}
             sort_lst = sorted(lst.iteritems(), key=operator.itemgetter(1),reverse=True)
             self.opt_d = sort_lst[0][0]
+        elif self.objective == "all":
+            self.opt_d = max(self.pruned)
+        else:
+            raise ValueError("Unknown objective %s (expected lower, coverage, ratio or all)" % self.objective)
 
-        elif self.objective == "coverage":
-            lst = {h : list(itertools.chain([self.pruned[h]["sum_upper"][g] for g in self.pruned[h]["sum_upper"].keys()]))
-                   for h in self.pruned if int(h) >= self.minD}
-            sort_lst = sorted(lst.iteritems(), key=operator.itemgetter(1),reverse=True)
-            self.opt_d = sort_lst[0][0]
+        return
 
-        elif self.objective == "ratio":
-            lst = {h : list(itertools.chain([float(self.pruned[h]["sum_lower"][g])/
-                                             self.pruned[h]["sum_upper"][g] for g in self.pruned[h]["sum_upper"].keys()])) for h in self.pruned
-                   if int(h) >= self.minD}
-            sort_lst = sorted(lst.iteritems(), key=operator.itemgetter(1),reverse=True)
-            self.opt_d = sort_lst[0][0]
+    @profiled
+    def enumerate_optimal_clusters(self):
+
+        """
+        Lazily enumerate, prune and optimize clusters over distances D [self.minD : self.maxD] without keeping
+        clusters for every distance D. Only the objective value of each distance D is retained, and full clusters
+        are materialized for the optimal distance D alone (replaces enumerate_clusters() + prune_clusters(optimize=True)).
+
+        If self.n_jobs > 1, objective values for all distances D are computed in parallel by worker processes
+        and the clusters for the optimal distance D are then enumerated once more
+
+        If distances are stored in self.distance_file, distances D are enumerated together in one pass over the file
+
+        For objective "all" every distance D is required, so all clusters are enumerated and pruned as before, and
+        self.optimal holds the pruned clusters of every distance D
+
+        :var self.pair_index
+        :var self.pair_dist
+        :var self.objective
+        :var self.n_jobs
+        :return: self.objective_values : objective value for each distance D [self.minD : self.maxD]
+        :return: self.opt_d : optimal integer distance D
+        :return: self.pruned, self.optimal : pruned clusters for optimal distance D only
+        :return: self.quality : quality metrics of optimal clusters (see get_cluster_quality())
+        """
+
+        if self.objective == "all":
+            self.enumerate_clusters()
+            self.prune_clusters(optimize=True)
+            return
+        elif self.objective not in ("lower","coverage","ratio"):
+            raise ValueError("Unknown objective %s (expected lower, coverage, ratio or all)" % self.objective)
+
+        self.objective_values = {}
+        best = None
+        if self.n_jobs > 1 and self.maxD - self.minD > 1 and self.distance_store is None:
+            pool = self.get_worker_pool(self.maxD - self.minD)
+            try:
+                for distance,value in pool.imap_unordered(_objective_level_worker,
+                                                          [(i,self.objective) for i in range(self.maxD-1,self.minD-1,-1)]):
+                    self.objective_values[distance] = value
+            finally:
+                pool.close()
+                pool.join()
         else:
-            self.opt_d = self.maxD
+            # Levels enumerated together from file are profiled as one phase, not per distance D
+            levels = None
+            if self.distance_store is not None:
+                levels = iter(self.enumerate_clusters_from_file(range(self.minD,self.maxD)))
+            for i in range(self.minD,self.maxD):
+                if levels is None:
+                    with profile_phase(self,"cluster_level",i):
+                        pruned = _cluster_level(self.pair_index,self.pair_dist,i,self.total_entities,
+                                                self.max_clusters,self.weights,self.groups)[-1]
+                else:
+                    pruned = _prune_level(next(levels)[0],self.max_clusters)
+                self.objective_values[i] = _objective_value(pruned,self.objective)
+                if best is None or self.objective_values[i] > self.objective_values[best[0]]:
+                    best = (i,pruned)	# Keep clusters of best distance D so far only
+
+        # Smallest distance D with maximum objective
+        self.opt_d = max(sorted(self.objective_values.iteritems()), key=operator.itemgetter(1))[0]
+        if best is None:
+            best = (self.opt_d,_cluster_level(self.pair_index,self.pair_dist,self.opt_d,self.total_entities,
+                                              self.max_clusters,self.weights,self.groups)[-1])
+        self.pruned = {self.opt_d : best[1]}
+        self.optimal = {self.opt_d : self.pruned[self.opt_d]}
+        self.get_cluster_quality()
+
+        if self.debug is True:
+            print "Objective Values for Distances D: ",self.objective_values
+            print "Optimal Intra-Entity Distance: ",self.opt_d
 
         return
 
+    @profiled
     def prune_clusters(self,optimize=False,cluster_name=0):
 
         """
         Prune all maxD clusters to number of clusters specified in self.max_clusters and associated rough clusters
         from all maxD clusters returned by enumerate_clusters()
 
+        Distances D already pruned for all of self.max_clusters (by parallel enumerate_clusters()) are not recomputed
+
         :arg (optional) cluster_name : if supplied only run for given cluster_name key in self.clusters
-        :var self.clusters : dictionary return of enumerate_clusters() containing rough clusters and upper/lower approximation sums
-        :var self.total_entities : total number of entities to be clustered
-        :return pruned : dictionary containing N clusters that maximize upper approximation
+        :var self.clusters : list return of enumerate_clusters() containing rough clusters for each distance D
+        :return pruned : dictionary containing N clusters that maximize upper approximation (views of self.clusters)
+        :return: self.quality : quality metrics of optimal clusters if optimize (see get_cluster_quality())
         """
 
         if cluster_name != 0:
             clusters_in = [self.clusters[cluster_name]]
         else:
-            clusters_in = deepcopy(self.clusters)
+            clusters_in = self.clusters
 
         for q,clusters in enumerate(clusters_in):
-            self.pruned[q+cluster_name] = {"cluster_num":{},"sum_lower":{},"sum_upper":{},"percent_covered":{},"cluster_list":{}}
-            cluster_upper_approx = {g : len(clusters[g]) for g in clusters}
-            tmpmem = sorted(cluster_upper_approx.iteritems(), key=operator.itemgetter(1),reverse=True)
-            clusters1 = []
-            cluster_count1 = []
-            cluster_list1 = []
-            for p,value in enumerate(self.max_clusters):
-                sorted_clusters = [t[0] for t in tmpmem[0:self.max_clusters[p]]]
-                clusters1.append({key : clusters[key] for key in sorted_clusters})
-                cluster_count1.append(len(clusters1[p].keys()))
-                cluster_list1.append(list(itertools.chain(*[clusters1[p][g] for g in clusters1[p].keys()])))
-                # Compute upper/lower approximations for pruned clusters
-                sum_all_1 = len(list(itertools.chain(*[clusters1[p][g] for g in clusters1[p].keys() if clusters1])))
-                sum_lower1 = 0
-                sum_upper1 = 0
-                intersections1 = {}
-                if len(clusters1[p].keys()) > 1:
-                    for key1 in clusters1[p]:
-                        intersections1[key1] = {key2 : list(set(clusters1[p][key1]).intersection(set(clusters1[p][key2])))
-                                         for key2 in clusters1[p] if key2 != key1}
-
-                        int_tmp1 = len(Counter(list(itertools.chain(*[intersections1[key1][g] for g in intersections1[key1]]))))
-                        sum_lower1 += (len(clusters1[p][key1]) - int_tmp1) #intersections[key1])
-                        sum_upper1 += len(clusters1[p][key1])
-                else:
-                    sum_lower1 = sum_all_1
-                    sum_upper1 = sum_all_1
-
-                if self.debug is True:
-                    print "Intra-Entity Distance : ",q
-                    print "Results for : ",self.max_clusters[p]," Pruned Clusters"
-                    print "Sum of Lower Approximation for Pruned Clusters :",sum_lower1
-                    print "Sum of Upper Approximations for Pruned Clusters",sum_upper1
-                    print "Number of Entities Covered for Pruned Clusters",len(Counter(cluster_list1[p]).keys())
-                    print "Percentage of Entities Covered for Pruned Clusters", \
-                        (len(Counter(cluster_list1[p]).keys())/float(self.total_entities))*100.0
+            if q+cluster_name in self.pruned and \
+                    all(value in self.pruned[q+cluster_name]["cluster_num"] for value in self.max_clusters):
+                continue
+            self.pruned[q+cluster_name] = _prune_level(clusters,self.max_clusters)
 
-                # Pack stats into output
-                self.pruned[q+cluster_name]["cluster_list"][value] = clusters1[p]
-                self.pruned[q+cluster_name]["cluster_num"][value] = cluster_count1[p]
-                self.pruned[q+cluster_name]["sum_lower"][value] = sum_lower1
-                self.pruned[q+cluster_name]["sum_upper"][value] = sum_upper1
-                self.pruned[q+cluster_name]["percent_covered"][value] = (len(Counter(cluster_list1[p]).keys())/float(self.total_entities))*100.0
+            if self.debug is True:
+                print "Intra-Entity Distance : ",q
+                for value in self.max_clusters:
+                    print "Results for : ",value," Pruned Clusters"
+                    print "Sum of Lower Approximation for Pruned Clusters :",self.pruned[q+cluster_name]["sum_lower"][value]
+                    print "Sum of Upper Approximations for Pruned Clusters",self.pruned[q+cluster_name]["sum_upper"][value]
+                    print "Percentage of Entities Covered for Pruned Clusters", \
+                        self.pruned[q+cluster_name]["percent_covered"][value]
 
         # Find optimal distance D cluster based on self.objective
         if optimize is True:
             self.optimize_clusters()
-            self.optimal = {self.opt_d : self.pruned[self.opt_d]}
+            if self.objective == "all":
+                self.optimal = dict(self.pruned)
+            else:
+                self.optimal = {self.opt_d : self.pruned[self.opt_d]}
+            self.get_cluster_quality()
+
+        return
+
+    @profiled
+    def get_cluster_quality(self):
+
+        """
+        Quality metrics (code/rough_metrics.py) of the optimal clusters for each number of clusters N in
+        self.max_clusters: approximation sizes, boundary ratio (fraction of covered entities in two or more
+        clusters), lower/boundary sum of squared distances to cluster means, rough Davies-Bouldin index about
+        cluster means, and rough silhouette with inter-entity distances from self.quality_sample sampled entities
+
+        A lower approximation holds the entities of a cluster in no other of the N clusters. If duplicates were
+        collapsed, metrics are weighted by entity multiplicity
+
+        :var self.optimal
+        :var self.opt_d
+        :var self.data_array
+        :var self.weights
+        :return: self.quality : dictionary of N : dictionary of metrics
+        """
+
+        self.quality = {}
+        weights = self.weights if self.weights is not None else npy.ones(self.data_array.shape[0])
+        for value,clusters in self.optimal[self.opt_d]["cluster_list"].iteritems():
+            upper = npy.zeros((self.data_array.shape[0],len(clusters)),dtype=bool)
+            for j,g in enumerate(clusters.cluster_ids()):
+                upper[clusters.members(g),j] = True
+            lower = upper & (npy.sum(upper,axis=1) == 1)[:,None]
+            with npy.errstate(invalid="ignore"):
+                centroids = npy.dot((upper * weights[:,None]).T,self.data_array) / \
+                    npy.dot(weights,upper)[:,None].astype(npy.float64)
+            self.quality[value] = rough_quality(self.data_array,centroids,upper,lower,self.get_block_distances,
+                                                weights,0.5,0.5,self.quality_sample,seed=0)
+
+        if self.debug is True:
+            print "Quality of Optimal Clusters: ",self.quality
+
+        return
+
+    @profiled
+    def add_entities(self,new_data):
+
+        """
+        Add new entities to existing clusters without recomputing distances or clusters of existing entities
+
+        Distances are computed only from the new entities to all entities (O(m*n) for m new entities), and new near
+        pairs are appended to self.pair_index/self.pair_dist and assigned in order to the existing clusters of each
+        distance D. This gives the same clusters as enumerate_clusters() over the extended pairs. Approximation sums,
+        pruned clusters and the optimal distance D are then updated. minD and maxD are kept from get_entity_distances().
+
+        If clusters of each distance D were not kept (enumerate_optimal_clusters()), optimal clusters are
+        re-enumerated from the extended pairs without recomputing any distances
+
+        :arg new_data : dictionary with <feature_name> : list pairs for the new entities
+        :var self.data_array
+        :var self.pair_index
+        :var self.pair_dist
+        :return: self.data, self.all_keys, self.total_entities : extended with new entities (keys follow existing)
+        :return: self.clusters, self.cluster_list, self.cluster_first, self.sum_lower, self.sum_upper : updated
+        :return: self.pruned, self.optimal, self.opt_d : updated
+        """
+
+        if self.distance_store is not None:
+            raise ValueError("add_entities is not supported with distances stored in distance_file")
+
+        t1 = time.time()
+
+        new_array = _integer_features(npy.asarray([new_data[val] for val in self.feature_names]).T)
+        dtype = npy.result_type(self.data_array,new_array)
+        self.data_array = self.data_array.astype(dtype,copy=False)
+        new_array = new_array.astype(dtype,copy=False)
+        num_new = new_array.shape[0]
+        self.data = {val : npy.concatenate((npy.asarray(self.data[val]),npy.asarray(new_data[val])))
+                     for val in self.feature_names}
+        self.all_keys.update({str(key): None for key in range(self.total_entities,self.total_entities+num_new)})
+        self.total_entities += num_new
+
+        rows = [npy.zeros(0,dtype=npy.int64)]
+        cols = [npy.zeros(0,dtype=npy.int64)]
+        dists = [npy.zeros(0,dtype=npy.int64)]
+        if self.weights is None:
+            new_rows = npy.arange(len(self.data_array),len(self.data_array)+num_new)
+            self.data_array = npy.concatenate((self.data_array,new_array))
+        else:
+            # Map new entities to existing or new unique entities
+            lookup = {row.tobytes(): u for u,row in enumerate(self.data_array)}
+            unique_index = npy.zeros(num_new,dtype=self.unique_index.dtype)
+            new_unique = []
+            for k,row in enumerate(new_array):
+                unique_index[k] = lookup.setdefault(row.tobytes(),len(self.data_array)+len(new_unique))
+                if unique_index[k] == len(self.data_array)+len(new_unique):
+                    new_unique.append(row)
+            previous = npy.append(self.weights,npy.zeros(len(new_unique),dtype=self.weights.dtype))
+            self.weights = previous + npy.bincount(unique_index,minlength=len(previous))
+            self.unique_index = npy.concatenate((self.unique_index,unique_index))
+            group_ptr = npy.zeros(len(self.weights)+1,dtype=npy.int64)
+            group_ptr[1:] = npy.cumsum(self.weights)
+            self.groups = (group_ptr,npy.argsort(self.unique_index,kind="mergesort").astype(npy.int32))
+            # Pair newly duplicated entities with themselves
+            duplicated = npy.nonzero((self.weights > 1) & (previous <= 1))[0]
+            rows.append(duplicated)
+            cols.append(duplicated)
+            dists.append(npy.zeros(len(duplicated),dtype=npy.int64))
+            new_rows = npy.arange(len(self.data_array),len(self.data_array)+len(new_unique))
+            if len(new_unique) > 0:
+                self.data_array = npy.concatenate((self.data_array,npy.asarray(new_unique)))
+
+        # Compute distance of new entities to all preceding entities and collect pairs with distance <= maxD
+        for k in range(0,len(new_rows),self.block_size):
+            block = new_rows[k:k+self.block_size]
+            block_dists = self.get_block_distances(block,slice(0,block[-1]))
+            row,col = npy.nonzero((block_dists <= self.maxD) & (npy.arange(block[-1])[None,:] < block[:,None]))
+            rows.append(col)
+            cols.append(block[row])
+            dists.append(block_dists[row,col])
+        rows = npy.concatenate(rows)
+        cols = npy.concatenate(cols)
+        order = self.get_pair_order(rows,cols)
+        new_index = npy.column_stack((rows[order],cols[order])).astype(npy.int32)
+        new_dist = npy.concatenate(dists)[order].astype(npy.int32)
+        self.pair_index = npy.concatenate((self.pair_index,new_index))
+        self.pair_dist = npy.concatenate((self.pair_dist,new_dist))
+
+        if self.debug is True:
+            print "New Entities to Cluster:",num_new
+            print "New Candidate Pairs within Max Distance:",len(new_dist)
+
+        if len(self.clusters) == 0:
+            if len(self.pruned) > 0:
+                self.enumerate_optimal_clusters()
+            return
+
+        # Assign new pairs to existing clusters of each distance D
+        for i,level in enumerate(self.clusters):
+            candidates = new_dist <= i
+            clusters,cluster_list,cluster_first = _assign_pairs(new_index[candidates,0],new_index[candidates,1],level,
+                                                                self.cluster_list[i],self.cluster_first[i])
+            self.clusters[i] = RoughClusterLevel.from_lists(clusters,self.total_entities,self.weights,self.groups)
+            self.cluster_list[i] = npy.asarray(cluster_list,dtype=npy.int32)
+            self.cluster_first[i] = npy.asarray(cluster_first,dtype=npy.int32)
+            self.sum_lower[i],self.sum_upper[i],_ = self.clusters[i].approximation_sums()
+
+        if len(self.pruned) > 0:
+            self.pruned = {}
+            self.prune_clusters(optimize=True)
+
+        if self.debug is True:
+            print "add_entities Time",time.time()-t1
 
         return
 
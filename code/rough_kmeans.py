@@ -24,6 +24,15 @@ Limited, 2012.
                                        centroid option below
     self.weighted_distance = wght    # Option (True) to use weighted
                                        distance centroid calculations
+    self.sample_weight = sample_weight # Count (weight) of each entity,
+                                       e.g. for pre-aggregated rows
+    self.max_iter = 300              # Maximum number of iterations
+    self.time_budget = None          # Seconds allowed for fitting
+    self.cancel_token = None         # Object with is_set() to cancel
+                                       fitting between phases
+    self.dtype = np.float64          # Float type of features, distances
+                                       and centroids (np.float32 halves
+                                       memory, see notes)
 
 @notes
 Distance threshold option:
@@ -44,6 +53,13 @@ Lower and Upper Approximation Weight options:
     The larger wght_lower is relative to wght_upper the more important
     cluster lower approximations will be and v.v
 
+Float type option:
+    self.dtype = np.float64 by default. With np.float32 the data, distance
+    matrix and centroids take half the memory; weighted means are still
+    accumulated in float64 and cast back, so centroids agree with float64
+    to about single precision (~1e-6 relative). Entities whose distance
+    ratio lies within rounding of self.dist_threshold may change approximation
+
 @author Michael Tompkins
 @copyright 2016
 """
@@ -51,10 +67,224 @@ Lower and Upper Approximation Weight options:
 # Externals
 import warnings
 import time
-import operator
 import numpy as np
 from copy import deepcopy
 
+# Package level imports
+from profiling import profiled, profile_phase
+from rough_metrics import rough_quality
+
+
+def _weighted_mean(values,weights):
+
+    """
+    Weighted mean of rows of values (nan for empty values, as np.mean),
+    accumulated in float64
+
+    :arg values : nd-array of entity vectors
+    :arg weights : weight of each entity
+    :return: weighted mean vector
+    """
+
+    return np.dot(weights,values.astype(np.float64)) / np.sum(weights)
+
+
+def _rough_approximations(distance_array,nearest,threshold,small):
+
+    """
+    Upper and lower approximation membership of entities given their distances to all cluster centroids.
+    An entity is in the upper approximation of its nearest cluster and of every cluster within threshold
+    times its nearest cluster distance, and in the lower approximation of its nearest cluster only if no
+    other cluster is that near
+
+    :arg distance_array : (entities x clusters) entity-centroid distances
+    :arg nearest : nearest cluster of each entity
+    :arg threshold : distance threshold (ratio to nearest cluster distance)
+    :arg small : smallest nearest cluster distance to take the ratio to
+    :return: (entities x clusters) boolean upper approx. membership, lower approx. cluster of each entity (-1 if boundary)
+    """
+
+    entities = np.arange(len(nearest))
+    best = np.maximum(distance_array[entities, nearest], small)
+    upper = distance_array / best[:, None] <= threshold
+    upper[entities, nearest] = True
+    lower = np.where(np.sum(upper, axis=1) == 1, nearest, -1)
+
+    return upper, lower
+
+
+class RoughMembership(object):
+
+    """
+    Rough k-means result as an (entities x clusters) upper approximation membership matrix plus the
+    lower approximation cluster of each entity (-1 for boundary entities, which are in two or more
+    upper approximations). The upper matrix may be bit-packed along clusters to save memory (1 bit per
+    entity-cluster pair), in which case it is unpacked on access
+    """
+
+    def __init__(self,upper,lower,packed=False):
+
+        self.n_entities, self.n_clusters = upper.shape
+        self.lower = np.asarray(lower,dtype=np.int32)      # Lower approx cluster of each entity (-1 if boundary)
+        self.packed = packed                                # Option (True) to bit-pack upper matrix
+        if packed is True:
+            self.upper_bits = np.packbits(upper,axis=1)     # Bit-packed upper approx membership
+        else:
+            self.upper_bits = np.asarray(upper,dtype=bool)  # Upper approx membership (entities x clusters)
+
+    def upper(self):
+
+        """
+        :return: boolean (entities x clusters) upper approximation membership matrix
+        """
+
+        if self.packed is True:
+            return np.unpackbits(self.upper_bits,axis=1)[:,:self.n_clusters].astype(bool)
+        return self.upper_bits
+
+    def lower_matrix(self):
+
+        """
+        :return: boolean (entities x clusters) lower approximation membership matrix
+        """
+
+        return self.lower[:,None] == np.arange(self.n_clusters)
+
+    def boundary(self,cluster=None):
+
+        """
+        Boundary region (upper - lower approximation) membership
+
+        :arg (optional) cluster : cluster index (None for all clusters)
+        :return: boolean (entities x clusters) boundary matrix, or boolean entity mask for cluster
+        """
+
+        if cluster is None:
+            return self.upper() & (self.lower == -1)[:,None]
+        return self.upper()[:,cluster] & (self.lower == -1)
+
+    def sizes(self):
+
+        """
+        :return: arrays of lower approximation, upper approximation and boundary region sizes of each cluster
+        """
+
+        upper = np.sum(self.upper(),axis=0)
+        lower = np.bincount(self.lower[self.lower >= 0],minlength=self.n_clusters)
+        return lower, upper, upper - lower
+
+    def entity_clusters(self,entity=None):
+
+        """
+        Upper approximation clusters of each entity in compressed sparse row form: the clusters of entity
+        e are indices[indptr[e]:indptr[e+1]]
+
+        :arg (optional) entity : entity index (None for all entities)
+        :return: (indptr,indices) for all entities, or array of clusters of entity
+        """
+
+        if entity is not None:
+            return np.flatnonzero(self.upper()[entity])
+        upper = self.upper()
+        indptr = np.zeros(self.n_entities+1,dtype=np.int64)
+        indptr[1:] = np.cumsum(np.sum(upper,axis=1))
+        return indptr, np.nonzero(upper)[1].astype(np.int32)
+
+    def contingency(self,labels,approximation="lower"):
+
+        """
+        Contingency table of cluster approximation membership counts against entity labels
+
+        :arg labels : label of each entity
+        :arg (optional) approximation : "lower", "upper" or "boundary"
+        :return: array of unique labels, (clusters x labels) table of entity counts
+        """
+
+        label_values, label_index = np.unique(np.asarray(labels),return_inverse=True)
+        if approximation == "lower":
+            members = self.lower >= 0
+            table = np.bincount(self.lower[members] * len(label_values) + label_index[members],
+                                minlength=self.n_clusters * len(label_values))
+            return label_values, table.reshape(self.n_clusters,len(label_values))
+        if approximation == "upper":
+            matrix = self.upper()
+        elif approximation == "boundary":
+            matrix = self.boundary()
+        else:
+            raise ValueError("approximation must be 'lower', 'upper' or 'boundary'")
+        one_hot = label_index[:,None] == np.arange(len(label_values))
+        return label_values, np.dot(matrix.T.astype(np.int64),one_hot.astype(np.int64))
+
+
+class RoughKMeansModel(object):
+
+    """
+    Fitted rough k-means model (saved by RoughKMeans.save_model()) that assigns new entities to the upper
+    and lower approximations of its clusters without refitting
+    """
+
+    def __init__(self,centroids,feature_names,dist_threshold,feature_mean=None,feature_std=None,small=1.0e-04):
+
+        self.centroids = np.asarray(centroids)                  # (clusters x features) centroids
+        self.feature_names = [str(name) for name in feature_names]  # Order of features in centroids
+        self.dist_threshold = float(dist_threshold)             # Threshold for centroids indiscernibility
+        self.feature_mean = feature_mean                        # Mean subtracted from each feature (None for 0)
+        self.feature_std = feature_std                          # Std. deviation dividing each feature (None for 1)
+        self.small = small
+
+    @classmethod
+    def load(cls,filename):
+
+        """
+        :arg filename : path of .npz model file written by RoughKMeans.save_model()
+        :return RoughKMeansModel
+        """
+
+        model = np.load(filename)
+        try:
+            return cls(model["centroids"],model["feature_names"].tolist(),model["dist_threshold"],
+                       model["feature_mean"],model["feature_std"],float(model["small"]))
+        finally:
+            model.close()
+
+    def transform(self,features):
+
+        """
+        :arg features : (entities x features) array in self.feature_names order, or dictionary with
+            <feature_name> : list/array pairs
+        :return: (entities x features) array normalized as the data the model was fit to
+        """
+
+        if isinstance(features,dict):
+            features = np.column_stack([np.asarray(features[name]) for name in self.feature_names])
+        features = np.array(features,dtype=self.centroids.dtype,ndmin=2)
+        if self.feature_mean is not None:
+            features -= self.feature_mean.astype(features.dtype)
+        if self.feature_std is not None:
+            features /= self.feature_std.astype(features.dtype)
+
+        return features
+
+    def predict(self,features):
+
+        """
+        Assign entities to the upper and lower approximations of the model clusters
+
+        :arg features : (entities x features) array in self.feature_names order, or dictionary with
+            <feature_name> : list/array pairs
+        :return: (entities x clusters) entity-centroid distances, nearest cluster of each entity,
+            (entities x clusters) boolean upper approx. membership, lower approx. cluster of each entity (-1 if boundary)
+        """
+
+        features = self.transform(features)
+        distance_array = np.empty((features.shape[0],self.centroids.shape[0]),dtype=features.dtype)
+        for l in range(self.centroids.shape[0]):
+            distance_array[:,l] = np.linalg.norm(features - self.centroids[l],axis=1)
+        nearest = np.argmin(distance_array,axis=1)
+        upper,lower = _rough_approximations(distance_array,nearest,self.dist_threshold,self.small)
+
+        return distance_array,nearest,upper,lower
+
 
 class RoughKMeans:
 
@@ -64,7 +294,8 @@ class RoughKMeans:
                  wght_upper=0.25,
                  threshold=1.25,
                  p_param=1.0,
-                 wght=False):
+                 wght=False,
+                 sample_weight=None):
 
         # Rough clustering options
         self.normalize = False            # Option to Z-score normalize features
@@ -76,6 +307,15 @@ class RoughKMeans:
         self.wght_upper = wght_upper        # Rel. weight of upper approx to each cluster centroid
         self.p_param = p_param              # parameter for weighted distance centroid option
         self.weighted_distance = wght       # Option (True) to use alt. weighted distance centroid
+        self.sample_weight = sample_weight  # Count (weight) of each entity (None for all 1)
+        self.dtype = np.float64             # Float type of features, distances and centroids
+        self.packed_membership = False      # Option (True) to bit-pack membership result upper matrix
+        self.profile = False                # Option (True) to record memory of phases and iterations
+        self.max_iter = 300                 # Maximum number of iterations (None for no limit)
+        self.time_budget = None             # Seconds allowed for fitting (None for no limit)
+        self.cancel_token = None            # Object whose is_set() is True to cancel fitting (e.g. threading.Event)
+        self.quality_sample = 500           # Number of sampled entities for silhouette quality (None to skip)
+        self.profiler = None                # MemoryProfiler of recorded phases (if profile)
 
         # Enforce wght_lower + wght_upper == 1.0
         if self.wght_lower + self.wght_upper > 1.0:
@@ -96,7 +336,18 @@ class RoughKMeans:
         self.cluster_list = {}              # Internal listing of membership for all clusters
         self.distance = {}                  # Entity-cluster distances for all candidate clusters
         self.clusters = None                # upper and lower approx membership for all clusters
-        self.d_weights = {}                 # Weight func. for entities if weighted_distance = True
+        self.d_weights = None               # Weight func. (entities x clusters) if weighted_distance = True
+        self.distance_array = None          # Entity-cluster distances (entities x clusters)
+        self.nearest = None                 # Nearest cluster of each entity
+        self.upper = None                   # Upper approx membership (entities x clusters)
+        self.lower = None                   # Lower approx cluster of each entity (-1 if boundary)
+        self.membership = None              # RoughMembership result of the fit
+        self.sweep = {}                     # Solutions for each k from sweep_clusters()
+        self.feature_mean = None            # Mean subtracted from each feature (in self.keylist order)
+        self.feature_std = None             # Std. deviation dividing each feature (in self.keylist order)
+        self.status = None                  # Convergence status of last fit
+        self.iterations = 0                 # Number of iterations of last fit
+        self.quality = None                 # Quality metrics of last fit (see get_quality())
 
         # Overhead
         self.timing = True                  # Timing print statements flag
@@ -107,6 +358,7 @@ class RoughKMeans:
         self.small = 1.0e-04
         self.large = 1.0e+10
 
+    @profiled
     def get_rough_clusters(self):
 
         """
@@ -115,8 +367,11 @@ class RoughKMeans:
 
         :return: self.centroids, self.assignments, self.upper_approximation,
         self.lower_approximation
+        :return: self.status : convergence status (see converge_centroids())
         """
 
+        started = time.time()
+
         # Transform data to nd-array for speed acceleration
         self.transform_data()
 
@@ -127,72 +382,361 @@ class RoughKMeans:
             warnings.warn("Rough distance threshold set <= 1.0 and will produce conventional \
             k-means solution")
 
-        # Iterate until centroids convergence
+        # Iterate until centroids convergence (or iteration, time budget or cancellation)
+        self.converge_centroids(started)
+
+        return self.status
+
+    @profiled
+    def converge_centroids(self,started=None):
+
+        """
+        Iterate rough k-means distance, approximation and centroid updates from the current
+        centroids until convergence
+
+        Iteration also stops after self.max_iter iterations, once self.time_budget seconds have
+        passed since started, or when self.cancel_token is set (checked between the distance,
+        approximation and centroid update phases). The solution of lowest rough cost found so far
+        (centroids with the approximations they produce) is then returned
+
+        :arg (optional) started : time the wall-clock budget is counted from (None for now)
+        :var self.centroids
+        :var self.max_iter
+        :var self.time_budget
+        :var self.cancel_token
+        :return: self.centroids, self.clusters, self.upper, self.lower, self.distance_array, self.nearest
+        :return: self.distance, self.cluster_list : entity keyed distances and nearest clusters
+        :return: self.membership : RoughMembership result
+        :return: self.status : "converged", "max_iter", "time_budget" or "cancelled"
+        :return: self.quality : quality metrics of solution (see get_quality(), not computed if cancelled)
+        :return: self.iterations : number of iterations run
+        """
+
+        if started is None:
+            started = time.time()
         ct = 0
         stop_flag = False
+        best = None
+        self.status = None
+        self.quality = None
+        self.previous_error = 1.0e+32
         while stop_flag is False:
 
+            if self.max_iter is not None and ct >= self.max_iter:
+                self.status = "max_iter"
+                break
+
             t1 = time.time()
-            # Back-store centroids
-            prev_centroids = deepcopy(self.centroids)
+            with profile_phase(self,"iteration",ct):
+                # Back-store centroids
+                prev_centroids = deepcopy(self.centroids)
+
+                # Get entity-cluster distances
+                self.get_entity_centroid_distances()
+                if self.get_interruption(started) is not None:
+                    break
+
+                # Compute upper and lower approximations
+                self.assign_cluster_upper_lower_approximation()
+
+                # Keep solution of lowest rough cost so far
+                cost = self.get_assignment_cost()
+                if best is None or cost < best[0]:
+                    best = (cost, prev_centroids, self.distance_array, self.nearest)
+                if self.get_interruption(started) is not None:
+                    break
+
+                # Update centroids with upper and lower approximations
+                if self.weighted_distance is True:        # Run entity-centroid weighted distance update
+                    self.update_centroids_weighted_distance()
+                else:   # Run standard rough k-means centroid update
+                    self.update_centroids()
+
+                # Determine if convergence reached
+                stop_flag = self.get_centroid_convergence(prev_centroids)
+                if stop_flag is True:
+                    self.status = "converged"
+                elif self.get_interruption(started) is not None:
+                    break
 
-            # Get entity-cluster distances
-            self.get_entity_centroid_distances()
+            t2 = time.time()
+            iter_time = t2-t1
+            print "Clustering Iteration", ct, " in: ", iter_time," secs"
+            ct += 1
 
-            # Compute upper and lower approximations
+        self.iterations = ct
+        if self.status != "converged":
+            # Restore best solution so far (or approximations of current centroids if none)
+            if best is not None:
+                cost, self.centroids, self.distance_array, self.nearest = best
+            else:
+                self.get_entity_centroid_distances()
             self.assign_cluster_upper_lower_approximation()
+            warnings.warn("Rough k-means stopped before convergence (%s) after %d iterations" % (self.status, ct))
 
-            # Update centroids with upper and lower approximations
-            if self.weighted_distance is True:        # Run entity-centroid weighted distance update
-                self.update_centroids_weighted_distance()
-            else:   # Run standard rough k-means centroid update
-                self.update_centroids()
+        # Entity keyed nearest clusters and entity-cluster distances of final iterate
+        self.cluster_list = {str(k): str(j) for k,j in enumerate(self.nearest.tolist())}
+        self.distance = {str(k): {str(j): dist for j,dist in enumerate(row)}
+                         for k,row in enumerate(self.distance_array.tolist())}
+        self.membership = RoughMembership(self.upper,self.lower,packed=self.packed_membership)
+        if self.status != "cancelled":
+            self.get_quality()
 
-            # Determine if convergence reached
-            stop_flag = self.get_centroid_convergence(prev_centroids)
+        return
 
-            t2 = time.time()
-            iter_time = t2-t1
-            print "Clustering Iteration", ct, " in: ", iter_time," secs"
-            ct += 1
+    @profiled
+    def sweep_clusters(self,max_k):
+
+        """
+        Fit rough k-means solutions for k = 2..max_k in one pass by bisection. The k=2
+        solution is fit from random centroids, then each k solution is warm-started from
+        the k-1 solution with the cluster of largest rough cost split in two along the
+        principal axis of its upper approximation, and iterated to convergence.
+
+        :arg max_k : largest number of clusters to fit
+        :var self.data_array
+        :return: self.sweep : dictionary for each k of "centroids", "clusters",
+        "cluster_cost" (rough cost of each cluster), "cost" (total rough cost),
+        "status" (convergence status) and "quality" (quality metrics). The sweep stops early at the time budget or
+        on cancellation (self.time_budget counts from the start of the sweep)
+        :return: self.centroids, self.clusters, self.max_clusters : max_k solution
+        """
+
+        started = time.time()
+        self.transform_data()
+        self.sweep = {}
+
+        self.max_clusters = 2
+        self.initialize_centroids()
+        self.converge_centroids(started)
+        self.record_sweep()
+
+        for k in range(3,max_k+1):
+
+            if self.status in ("time_budget", "cancelled"):
+                break
+
+            # Bisect cluster of largest rough cost with at least 2 entities
+            cluster_cost = self.sweep[k-1]["cluster_cost"]
+            worst = [g for g in sorted(cluster_cost, key=cluster_cost.get, reverse=True)
+                     if len(self.clusters[g]["upper"]) > 1]
+            if len(worst) == 0:
+                warnings.warn("No cluster with more than 1 entity left to split at k=%d" % k)
+                break
+            members = self.data_array[self.clusters[worst[0]]["upper"], :]
+            weights = self.sample_weight[self.clusters[worst[0]]["upper"]]
+            centered = members - _weighted_mean(members, weights)
+            projection = np.dot(centered, np.linalg.svd(centered, full_matrices=False)[2][0])
+            if np.all(projection >= 0) or np.all(projection < 0):
+                projection = np.arange(len(members)) - len(members) / 2.0
+            self.centroids[worst[0]] = _weighted_mean(members[projection < 0], weights[projection < 0])
+            self.centroids[str(k-1)] = _weighted_mean(members[projection >= 0], weights[projection >= 0])
+
+            self.max_clusters = k
+            self.converge_centroids(started)
+            self.record_sweep()
+
+        return
+
+    def record_sweep(self):
+
+        """
+        Store current solution and its rough cost in self.sweep for k = self.max_clusters
+
+        :var self.centroids
+        :var self.clusters
+        :return: self.sweep[self.max_clusters]
+        """
+
+        cluster_cost = self.get_rough_cost()
+        self.sweep[self.max_clusters] = {"centroids": deepcopy(self.centroids),
+                                         "clusters": deepcopy(self.clusters),
+                                         "cluster_cost": cluster_cost,
+                                         "cost": np.sum(cluster_cost.values()),
+                                         "status": self.status,
+                                         "quality": self.quality}
+
+        if self.timing is True:
+            print "Sweep k =",self.max_clusters,"rough cost",self.sweep[self.max_clusters]["cost"]
+
+        return
+
+    def get_interruption(self,started):
+
+        """
+        Check cancellation token and wall-clock budget
+
+        :arg started : time the wall-clock budget is counted from
+        :var self.cancel_token
+        :var self.time_budget
+        :return: self.status : "cancelled", "time_budget" or None (to continue)
+        """
+
+        if self.cancel_token is not None and self.cancel_token.is_set():
+            self.status = "cancelled"
+        elif self.time_budget is not None and time.time() - started >= self.time_budget:
+            self.status = "time_budget"
+        else:
+            return None
+
+        return self.status
+
+    def get_assignment_cost(self):
+
+        """
+        Total rough cost of the current approximations about the centroids they were assigned
+        from, computed from the entity-centroid distances
+
+        :var self.distance_array
+        :var self.upper
+        :var self.lower
+        :var self.sample_weight
+        :return: rough cost
+        """
+
+        lower_set = self.lower >= 0
+        squared = self.distance_array.astype(np.float64)**2
+        boundary = self.upper & ~lower_set[:, None]
+
+        return self.wght_lower * np.dot(self.sample_weight[lower_set], squared[lower_set, self.lower[lower_set]]) + \
+            self.wght_upper * np.dot(self.sample_weight, np.sum(squared * boundary, axis=1))
+
+    @profiled
+    def get_quality(self):
+
+        """
+        Quality metrics (code/rough_metrics.py) of the current solution from its membership arrays:
+        approximation sizes, boundary ratio, weighted lower/boundary sum of squared distances to
+        centroids, rough Davies-Bouldin index and rough silhouette estimated from
+        self.quality_sample sampled entities
+
+        :var self.data_array
+        :var self.centroids
+        :var self.upper
+        :var self.lower
+        :var self.sample_weight
+        :return: self.quality : dictionary of metrics
+        """
+
+        data_array = self.data_array
+        squared = np.sum(data_array.astype(np.float64)**2, axis=1)
+
+        def block_distances(rows, cols):
+            products = np.dot(data_array[rows].astype(np.float64), data_array[cols].astype(np.float64).T)
+            return np.sqrt(np.maximum(squared[rows][:, None] + squared[cols][None, :] - 2 * products, 0))
+
+        centroids = np.asarray([self.centroids[str(q)] for q in range(self.max_clusters)], dtype=np.float64)
+        self.quality = rough_quality(data_array, centroids, self.upper, self.membership.lower_matrix(),
+                                     block_distances, self.sample_weight, self.wght_lower, self.wght_upper,
+                                     self.quality_sample, seed=0)
+
+        return
+
+    def get_rough_cost(self):
+
+        """
+        Rough cost of each cluster: weighted sum of squared entity-centroid distances of
+        its lower approximation (wght_lower) and boundary region (wght_upper), with each
+        entity counted by its sample weight
+
+        :var self.data_array
+        :var self.centroids
+        :var self.upper
+        :var self.lower
+        :var self.sample_weight
+        :return: dictionary of rough cost for each cluster
+        """
+
+        cluster_cost = {}
+        for q in range(self.max_clusters):
+            lower_set = self.lower == q
+            boundary_set = self.upper[:, q] & ~lower_set
+            centroid = np.asarray(self.centroids[str(q)], dtype=self.dtype)
+            lower = self.data_array[lower_set, :] - centroid
+            boundary = self.data_array[boundary_set, :] - centroid
+            cluster_cost[str(q)] = \
+                self.wght_lower * np.dot(self.sample_weight[lower_set], np.sum(lower**2, axis=1)) + \
+                self.wght_upper * np.dot(self.sample_weight[boundary_set], np.sum(boundary**2, axis=1))
+
+        return cluster_cost
+
+    def save_model(self,filename):
+
+        """
+        Save fitted centroids, distance threshold, feature order and normalization to an .npz file that
+        RoughKMeansModel.load() reads for scoring new entities
+
+        :arg filename : path of .npz model file
+        :var self.centroids
+        :var self.keylist
+        :var self.feature_mean
+        :var self.feature_std
+        """
+
+        np.savez(filename,
+                 centroids=np.asarray([self.centroids[str(q)] for q in range(self.max_clusters)], dtype=self.dtype),
+                 feature_names=np.asarray(self.keylist), dist_threshold=self.dist_threshold,
+                 feature_mean=self.feature_mean, feature_std=self.feature_std, small=self.small)
 
         return
 
+    @profiled
     def transform_data(self):
 
         """
-        Convert input data dictionary to float nd-array for
+        Convert input data dictionary to float (self.dtype) nd-array for
         accelerated clustering speed
 
         :var self.data
+        :var self.sample_weight
+        :var self.dtype
         :return: self.data_array
+        :return: self.sample_weight : float array of entity weights
+        :return: self.feature_mean, self.feature_std : normalization of each feature (0 and 1 if not normalized)
         """
 
         t1 = time.time()
         self.keylist = self.data.keys()
         self.tableau_lists = [self.data[key][:] for key in self.data]
-        self.data_array = np.asfarray(self.tableau_lists).T
+        self.data_array = np.asarray(self.tableau_lists, dtype=self.dtype).T
+        if self.sample_weight is None:
+            self.sample_weight = np.ones(self.data_length)
+        else:
+            self.sample_weight = np.asfarray(self.sample_weight)
 
-        # Normalize if requested
+        # Normalize if requested (weighted mean and std, accumulated in float64 by feature)
+        self.feature_mean = np.zeros(self.data_array.shape[1])
+        self.feature_std = np.ones(self.data_array.shape[1])
         if self.normalize is True:
-            self.data_array -= np.mean(self.data_array, axis=0)
-            tmp_std = np.std(self.data_array, axis=0)
             for i in range(len(self.data_array[0, :])):
-                if tmp_std[i] >= 0.001:
-                    self.data_array[:, i] /= tmp_std[i]
+                feature = self.data_array[:, i].astype(np.float64)
+                tmp_mean = np.dot(self.sample_weight, feature) / np.sum(self.sample_weight)
+                tmp_std = np.sqrt(np.dot(self.sample_weight, (feature - tmp_mean)**2) / np.sum(self.sample_weight))
+                feature -= tmp_mean
+                self.feature_mean[i] = tmp_mean
+                if tmp_std >= 0.001:
+                    feature /= tmp_std
+                    self.feature_std[i] = tmp_std
+                self.data_array[:, i] = feature
 
         if self.timing is True:
             t3 = time.time()
             print "transform_data Time",t3-t1
             print "shape",self.data_array.shape
 
+    @profiled
     def initialize_centroids(self):
 
         """
         Randomly select [self.max_clusters] initial entities as
         centroids and assign to self.centroids
 
+        If entities are weighted, entities of positive weight are selected
+        in proportion to their weight (entities of zero weight only if
+        fewer than max_clusters entities have positive weight)
+
         :var self.max_clusters
+        :var self.sample_weight
         :var self.data
         :var self.data_array
         :var self.feature_names
@@ -203,7 +747,20 @@ class RoughKMeans:
 
         # Select max cluster random entities from input and assign as
         # initial cluster centroids
-        candidates = np.random.permutation(self.data_length)[0:self.max_clusters]
+        weights = self.sample_weight
+        if np.all(weights == weights[0]):    # Unweighted entities
+            candidates = np.random.permutation(self.data_length)[0:self.max_clusters]
+        else:                                # In proportion to entity weight
+            positive = np.flatnonzero(weights > 0)
+            num_weighted = min(self.max_clusters, len(positive))
+            candidates = np.zeros(0, dtype=np.int64)
+            if num_weighted > 0:
+                candidates = np.random.choice(positive, num_weighted, replace=False,
+                                              p=weights[positive]/np.sum(weights[positive]))
+            if num_weighted < self.max_clusters:    # Fill with entities of zero weight
+                zero = np.flatnonzero(weights <= 0)
+                candidates = np.concatenate((candidates,
+                                             np.random.permutation(zero)[0:self.max_clusters-num_weighted]))
 
         if self.debug is True:
             print "Candidates",candidates,self.feature_names,self.data
@@ -211,7 +768,7 @@ class RoughKMeans:
         # self.centroids = {str(k): {v: self.data[v][candidates[k]] for v in self.feature_names} for
         #                  k in range(self.max_clusters)}
 
-        self.centroids = {str(k): self.data_array[candidates[k], :] for k in
+        self.centroids = {str(k): self.data_array[candidates[k], :].copy() for k in
                           range(self.max_clusters)}
 
         if self.timing is True:
@@ -221,6 +778,7 @@ class RoughKMeans:
 
         return
 
+    @profiled
     def get_centroid_convergence(self,previous_centroids):
 
         """
@@ -255,6 +813,7 @@ class RoughKMeans:
             self.previous_error = centroid_error.copy()
             return False
 
+    @profiled
     def update_centroids_weighted_distance(self):
 
         """
@@ -274,53 +833,44 @@ class RoughKMeans:
         :var self.data_array
         :var self.wght_lower
         :var self.wght_upper
-        :var self.feature_names
-        :var self.clusters
+        :var self.upper
+        :var self.lower
         :var self.d_weights
+        :var self.sample_weight
         :return: self.centroids : updated cluster centroids
         """
 
         t1 = time.time()
 
-        for k in self.clusters:
+        for q in range(self.max_clusters):
+
+            lower_set = self.lower == q
+            upper_set = self.upper[:, q]
+            weights = self.sample_weight * self.d_weights[:, q]
 
-            if len(self.clusters[k]["lower"]) == len(self.clusters[k]["upper"]) and \
-                            len(self.clusters[k]["lower"]) != 0:
+            if np.count_nonzero(lower_set) == np.count_nonzero(upper_set) and np.any(lower_set):
                 # Get lower approximation vectors and distance weights
-                weights = np.asarray([self.d_weights[k][str(l)] for l in self.clusters[k]["lower"]])
-                weights /= np.sum(weights)
-                self.centroids[str(k)] = \
-                    np.sum([weights[m] * self.data_array[l,:]
-                            for m,l in enumerate(self.clusters[k]["lower"])], axis=0)
+                centroid = _weighted_mean(self.data_array[lower_set, :], weights[lower_set])
 
-            elif len(self.clusters[k]["lower"]) == 0 and len(self.clusters[k]["upper"]) != 0:
+            elif not np.any(lower_set) and np.any(upper_set):
                 # Get upper approximation vectors
-                weights = np.asarray(
-                    [self.d_weights[k][str(l)] for l in self.clusters[k]["upper"]])
-                weights /= np.sum(weights)
-                self.centroids[str(k)] = \
-                    np.sum([weights[m] * self.data_array[l, :]
-                            for m,l in enumerate(self.clusters[k]["upper"])], axis=0)
+                centroid = _weighted_mean(self.data_array[upper_set, :], weights[upper_set])
 
             else:
                 # Get both upper-exclusive and lower approximation sets
-                exclusive_set = \
-                    list(set(self.clusters[k]["upper"]).difference(set(self.clusters[k]["lower"])))
-                weights1 = np.asarray(
-                    [self.d_weights[k][str(l)] * self.data_array[l, :]
-                     for l in self.clusters[k]["lower"]])
+                lower = self.data_array[lower_set, :].astype(np.float64)
+                boundary = self.data_array[upper_set & ~lower_set, :].astype(np.float64)
+                weights1 = weights[lower_set][:, None] * lower
                 weights1 /= np.sum(weights1)
-                weights2 = np.asarray(
-                    [self.d_weights[k][str(l)] * self.data_array[l, :] for l in exclusive_set])
+                weights2 = weights[upper_set & ~lower_set][:, None] * boundary
                 weights2 /= np.sum(weights2)
-                self.centroids[str(k)] = \
-                    self.wght_lower * np.sum([weights1[m] * self.data_array[l, :]
-                                              for m,l in enumerate(self.clusters[k]["lower"])], axis=0) \
-                    + self.wght_upper * np.sum([weights2[m] * self.data_array[l, :]
-                                                for m,l in enumerate(exclusive_set)], axis=0)
+                centroid = self.wght_lower * np.sum(weights1 * lower, axis=0) \
+                    + self.wght_upper * np.sum(weights2 * boundary, axis=0)
+
+            self.centroids[str(q)] = centroid.astype(self.dtype)
 
             if self.debug_update is True:
-                print """###Cluster""", k, self.clusters[k]["lower"], self.clusters[k]["upper"]
+                print """###Cluster""", q, np.flatnonzero(lower_set), np.flatnonzero(upper_set)
 
         if self.timing is True:
             t3 = time.time()
@@ -328,6 +878,7 @@ class RoughKMeans:
 
         return
 
+    @profiled
     def update_centroids(self):
 
         """
@@ -345,37 +896,38 @@ class RoughKMeans:
         :var self.data_array
         :var self.wght_lower
         :var self.wght_upper
-        :var self.feature_names
-        :var self.clusters
+        :var self.upper
+        :var self.lower
+        :var self.sample_weight
         :return: self.centroids : updated cluster centroids
         """
 
         t1 = time.time()
 
-        for k in self.clusters:
+        for q in range(self.max_clusters):
 
-            if len(self.clusters[k]["lower"]) == len(self.clusters[k]["upper"]):
+            lower_set = self.lower == q
+            upper_set = self.upper[:, q]
+
+            if np.count_nonzero(lower_set) == np.count_nonzero(upper_set):
                 # Get lower approximation vectors
-                lower = self.data_array[self.clusters[k]["lower"], :]
-                self.centroids[str(k)] = np.mean(lower,axis=0)
+                centroid = _weighted_mean(self.data_array[lower_set, :], self.sample_weight[lower_set])
 
-            elif len(self.clusters[k]["lower"]) == 0 and len(self.clusters[k]["upper"]) != 0:
+            elif not np.any(lower_set) and np.any(upper_set):
                 # Get upper approximation vectors
-                upper = self.data_array[self.clusters[k]["upper"], :]
-                self.centroids[str(k)] = np.mean(upper,axis=0)
+                centroid = _weighted_mean(self.data_array[upper_set, :], self.sample_weight[upper_set])
 
             else:
                 # Get both upper-exclusive and lower approximation sets
-                # upper = self.data_array[self.clusters[k]["upper"], :]
-                lower = self.data_array[self.clusters[k]["lower"], :]
-                exclusive_set = \
-                    list(set(self.clusters[k]["upper"]).difference(set(self.clusters[k]["lower"])))
-                boundary = self.data_array[exclusive_set, :]
-                self.centroids[str(k)] = \
-                    self.wght_lower*np.mean(lower,axis=0) + self.wght_upper*np.mean(boundary,axis=0)
+                boundary_set = upper_set & ~lower_set
+                centroid = \
+                    self.wght_lower*_weighted_mean(self.data_array[lower_set, :], self.sample_weight[lower_set]) + \
+                    self.wght_upper*_weighted_mean(self.data_array[boundary_set, :], self.sample_weight[boundary_set])
+
+            self.centroids[str(q)] = centroid.astype(self.dtype)
 
             if self.debug_update is True:
-                print """###Cluster""", k, self.clusters[k]["lower"], self.clusters[k]["upper"]
+                print """###Cluster""", q, np.flatnonzero(lower_set), np.flatnonzero(upper_set)
 
         if self.timing is True:
             t3 = time.time()
@@ -383,57 +935,46 @@ class RoughKMeans:
 
         return
 
+    @profiled
     def assign_cluster_upper_lower_approximation(self):
 
         """
         Compute entity-to-cluster optimal assignments +
         upper/lower approximations for all current clusters
 
-        :var self.distance
-        :var self.distance_threshold
-        :var self.cluster_list
+        An entity belongs to the upper approximation of its nearest cluster
+        and of every cluster within self.dist_threshold times its nearest
+        cluster distance. It belongs to the lower approximation of its
+        nearest cluster only if no other cluster is that near.
+
+        :var self.distance_array
+        :var self.nearest
+        :var self.dist_threshold
         :var self.max_clusters
-        :var self.data_length
+        :return: self.upper : (entities x clusters) boolean upper approx. membership
+        :return: self.lower : lower approx. cluster of each entity (-1 for boundary entities)
+        :return: self.d_weights : (entities x clusters) distance weights
         :return: self.clusters[clusters]["upper"] : upper approx.
         :return: self.clusters[clusters]["lower"] : lower approx.
         """
 
         t1 = time.time()
 
-        # Reset clusters and distance weights for each method call
-        self.clusters = {str(q): {"upper": [], "lower": []} for q in range(self.max_clusters)}
-        self.d_weights = {str(q): {} for q in range(self.max_clusters)}
-
-        # Assign each entity to cluster upper/lower approximations as appropriate
-        for k in range(0, self.data_length):
-            v_clust = self.cluster_list[str(k)]     # Current entity nearest cluster
-
-            # Compile all clusters for each entity that are within
-            # self.threshold distance of best entity cluster
-            T = {j: self.distance[str(k)][j] / np.max([self.distance[str(k)][v_clust], self.small])
-                 for j in self.distance[str(k)] if
-                 (self.distance[str(k)][j] / np.max([self.distance[str(k)][v_clust], self.small])
-                  <= self.dist_threshold)
-                 and (v_clust != j)}
-
-            # Assign entity to lower and upper approximations of all clusters as needed
-            if len(T.keys()) > 0:
-                self.clusters[v_clust]["upper"].append(k)      # Assign entity to its nearest cluster upper approx.
-                self.d_weights[v_clust][str(k)] = \
-                    ((2 / np.pi) * np.arctan(-self.p_param * (self.distance[str(k)][v_clust]))) + 1
-                for cluster_name in T:
-                    self.clusters[cluster_name]["upper"].append(k)  # Assign entity to upper approx of near cluster
-                    self.d_weights[cluster_name][str(k)] = \
-                        ((2 / np.pi) * np.arctan(-self.p_param * (self.distance[str(k)][cluster_name]))) + 1
-            else:
-                self.clusters[v_clust]["upper"].append(k)      # Assign entity to its nearest cluster upper approx.
-                self.clusters[v_clust]["lower"].append(k)      # Assign entity to its nearest cluster lower approx.
-                self.d_weights[v_clust][str(k)] = \
-                    ((2 / np.pi) * np.arctan(-self.p_param * (self.distance[str(k)][v_clust]))) + 1
-            if self.debug_assign is True:
-                print "Current Cluster", v_clust
-                print "distance", self.distance[str(k)]
-                print "T",T
+        # Compile all clusters for each entity that are within self.threshold distance of best
+        # entity cluster, and assign entity to lower approximation of nearest cluster if in no other
+        self.upper, self.lower = \
+            _rough_approximations(self.distance_array, self.nearest, self.dist_threshold, self.small)
+
+        self.d_weights = ((2 / np.pi) * np.arctan(-self.p_param * self.distance_array)) + 1
+
+        self.clusters = {str(q): {"upper": np.flatnonzero(self.upper[:, q]).tolist(),
+                                  "lower": np.flatnonzero(self.lower == q).tolist()}
+                         for q in range(self.max_clusters)}
+
+        if self.debug_assign is True:
+            print "Current Clusters", self.nearest
+            print "distance", self.distance_array
+            print "Upper", self.upper
 
         if self.timing is True:
             t3 = time.time()
@@ -441,6 +982,7 @@ class RoughKMeans:
 
         return
 
+    @profiled
     def get_entity_centroid_distances(self):
 
         """
@@ -450,8 +992,8 @@ class RoughKMeans:
         :var self.data_array : nd-array of all features for all entities
         :var self.centroids : nd-array of all cluster centroids
         :var self.max_clusters
-        :return: self.distance : centroid-entity distance vectors
-        :return self.cluster_list : best fit cluster-entity assignment
+        :return: self.distance_array : (entities x clusters) entity-centroid distances
+        :return self.nearest : best fit cluster of each entity
         """
 
         t1 = time.time()
@@ -467,18 +1009,15 @@ class RoughKMeans:
         #     self.cluster_list[str(k)] = best_key
         # t2 = time.time()
 
-        tmp = []
+        self.distance_array = np.empty((self.data_length, self.max_clusters), dtype=self.dtype)
         for l in range(0,self.max_clusters):
-            tmp.append(np.linalg.norm(self.data_array - np.asarray(self.centroids[str(l)]),axis=1))
-
-        for k in range(0,self.data_length):
-            self.distance[str(k)] = {str(j): tmp[j][k] for j in range(self.max_clusters)}
-            best_key = min(self.distance[str(k)].iteritems(), key=operator.itemgetter(1))[0]
-            self.cluster_list[str(k)] = best_key
+            self.distance_array[:, l] = \
+                np.linalg.norm(self.data_array - np.asarray(self.centroids[str(l)], dtype=self.dtype),axis=1)
+        self.nearest = np.argmin(self.distance_array, axis=1)
 
         if self.debug_dist is True:
-            print "Cluster List",self.cluster_list
-            print "Distances",self.distance
+            print "Cluster List",self.nearest
+            print "Distances",self.distance_array
 
         # Determine self.dist_threshold based on percentile all entity-cluster distances
         # curr_dists = list(itertools.chain([self.distance[h][g] for h in self.distance for g in self.distance[h]]))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+@description
+Vectorized quality metrics for rough clusters given as (entities x clusters) boolean upper and lower approximation
+membership matrices, shared by RoughKMeans and RoughCluster:
+
+    boundary_ratio : (weighted) fraction of clustered entities in the boundary region of two or more clusters
+    lower_sse, boundary_sse : weighted sum of squared distances to cluster centroids of the lower approximation and
+        boundary region of each cluster
+    rough_db : rough Davies-Bouldin index, with the scatter of each cluster the wght_lower/wght_upper weighted rms
+        distance of its lower approximation and boundary region to its centroid (lower is better)
+    silhouette : rough silhouette estimated from sampled entities, where a is the (weighted) mean distance of an
+        entity to the nearest cluster it belongs to and b to the nearest cluster it does not belong to (higher is better)
+
+@notes
+The silhouette is O(sample x entities) and computed in blocks of entities, so the full distance matrix is never held
+"""
+
+# Externals
+import numpy as np
+
+
+def approximation_sizes(upper,lower,weights=None):
+
+    """
+    :arg upper : (entities x clusters) boolean upper approximation membership
+    :arg lower : (entities x clusters) boolean lower approximation membership
+    :arg (optional) weights : weight of each entity (None for 1)
+    :return: arrays of (weighted) lower approximation, upper approximation and boundary region sizes of each cluster
+    """
+
+    weights = np.ones(upper.shape[0]) if weights is None else np.asarray(weights,dtype=np.float64)
+    lower_sizes = np.dot(weights,lower)
+    upper_sizes = np.dot(weights,upper)
+
+    return lower_sizes, upper_sizes, upper_sizes - lower_sizes
+
+
+def boundary_ratio(upper,lower,weights=None):
+
+    """
+    :arg upper : (entities x clusters) boolean upper approximation membership
+    :arg lower : (entities x clusters) boolean lower approximation membership
+    :arg (optional) weights : weight of each entity (None for 1)
+    :return: (weighted) fraction of clustered entities that are in no lower approximation
+    """
+
+    weights = np.ones(upper.shape[0]) if weights is None else np.asarray(weights,dtype=np.float64)
+    clustered = np.any(upper,axis=1)
+    boundary = clustered & ~np.any(lower,axis=1)
+
+    return np.sum(weights[boundary]) / max(np.sum(weights[clustered]),1.0e-32)
+
+
+def approximation_sse(features,centroids,upper,lower,weights=None):
+
+    """
+    :arg features : (entities x features) array
+    :arg centroids : (clusters x features) array
+    :arg upper : (entities x clusters) boolean upper approximation membership
+    :arg lower : (entities x clusters) boolean lower approximation membership
+    :arg (optional) weights : weight of each entity (None for 1)
+    :return: arrays of weighted sum of squared distances to centroid of lower approximation and boundary region
+        of each cluster
+    """
+
+    weights = np.ones(upper.shape[0]) if weights is None else np.asarray(weights,dtype=np.float64)
+    lower_sse = np.zeros(len(centroids))
+    boundary_sse = np.zeros(len(centroids))
+    for q in range(len(centroids)):
+        members = np.flatnonzero(upper[:,q])
+        squared = np.sum((features[members].astype(np.float64) - centroids[q])**2,axis=1) * weights[members]
+        in_lower = lower[members,q]
+        lower_sse[q] = np.sum(squared[in_lower])
+        boundary_sse[q] = np.sum(squared[~in_lower])
+
+    return lower_sse, boundary_sse
+
+
+def rough_davies_bouldin(centroids,lower_sse,boundary_sse,lower_sizes,boundary_sizes,wght_lower=0.75,wght_upper=0.25):
+
+    """
+    Rough Davies-Bouldin index: mean over clusters of the largest (S_i + S_j) / ||c_i - c_j|| over other clusters j,
+    where the scatter S of a cluster is wght_lower * rms lower approximation distance + wght_upper * rms boundary
+    distance (the rms distance of whichever is non-empty if the other is empty)
+
+    :arg centroids : (clusters x features) array
+    :arg lower_sse, boundary_sse : weighted sum of squared distances to centroid of each cluster
+    :arg lower_sizes, boundary_sizes : (weighted) sizes of each cluster
+    :arg (optional) wght_lower, wght_upper : relative weights of lower approximation and boundary region
+    :return: rough Davies-Bouldin index (nan for fewer than 2 clusters)
+    """
+
+    if len(centroids) < 2:
+        return np.nan
+    with np.errstate(invalid="ignore",divide="ignore"):
+        lower_rms = np.sqrt(lower_sse / lower_sizes)
+        boundary_rms = np.sqrt(boundary_sse / boundary_sizes)
+    scatter = np.where(lower_sizes > 0,
+                       np.where(boundary_sizes > 0,wght_lower * lower_rms + wght_upper * boundary_rms,lower_rms),
+                       np.where(boundary_sizes > 0,boundary_rms,0.0))
+    centroids = np.asarray(centroids,dtype=np.float64)
+    separation = np.sqrt(np.sum((centroids[:,None,:] - centroids[None,:,:])**2,axis=2))
+    with np.errstate(invalid="ignore",divide="ignore"):
+        ratio = (scatter[:,None] + scatter[None,:]) / separation
+    ratio[np.arange(len(centroids)),np.arange(len(centroids))] = -np.inf
+
+    return float(np.mean(np.max(ratio,axis=1)))
+
+
+def sampled_silhouette(block_distances,upper,weights=None,sample_size=500,block_size=4096,seed=None):
+
+    """
+    Rough silhouette (b - a) / max(a,b) averaged over sampled clustered entities, where a is the weighted mean
+    distance of an entity to the other members of the nearest cluster it belongs to, and b to the members of the
+    nearest cluster it does not belong to. Entities alone in their clusters score 0. Weights count entity
+    multiplicity, so other copies of a sampled entity count as other members
+
+    :arg block_distances : function of (sample entity indices, slice of entities) returning their distance array
+    :arg upper : (entities x clusters) boolean upper approximation membership
+    :arg (optional) weights : weight of each entity (None for 1)
+    :arg (optional) sample_size : number of entities sampled (with probability proportional to weight)
+    :arg (optional) block_size : number of entities per block of distances
+    :arg (optional) seed : random seed of sample
+    :return: estimated rough silhouette (nan for fewer than 2 clusters)
+    """
+
+    total,num_clusters = upper.shape
+    weights = np.ones(total) if weights is None else np.asarray(weights,dtype=np.float64)
+    clustered = np.flatnonzero(np.any(upper,axis=1) & (weights > 0))
+    if num_clusters < 2 or len(clustered) == 0:
+        return np.nan
+    p = weights[clustered] / np.sum(weights[clustered])
+    sample = np.random.RandomState(seed).choice(clustered,min(sample_size,len(clustered)),replace=False,p=p)
+
+    # Weighted distance sums from sampled entities to members of each cluster, block by block
+    member_weights = upper * weights[:,None]
+    sums = np.zeros((len(sample),num_clusters))
+    for k in range(0,total,block_size):
+        block = slice(k,min(k+block_size,total))
+        sums += np.dot(block_distances(sample,block).astype(np.float64),member_weights[block])
+    counts = np.sum(member_weights,axis=0)[None,:] - upper[sample] * np.minimum(weights[sample],1.0)[:,None]
+
+    with np.errstate(invalid="ignore",divide="ignore"):
+        mean_dists = sums / counts
+    own = upper[sample]
+    a = np.min(np.where(own & (counts > 0),mean_dists,np.inf),axis=1)
+    b = np.min(np.where(~own & (counts > 0),mean_dists,np.inf),axis=1)
+    with np.errstate(invalid="ignore"):
+        score = np.where(np.isfinite(a) & np.isfinite(b),(b - a) / np.maximum(np.maximum(a,b),1.0e-32),0.0)
+
+    return float(np.mean(score))
+
+
+def rough_quality(features,centroids,upper,lower,block_distances,weights=None,wght_lower=0.75,wght_upper=0.25,
+                  sample_size=500,seed=None):
+
+    """
+    All rough cluster quality metrics
+
+    :arg features : (entities x features) array
+    :arg centroids : (clusters x features) array
+    :arg upper : (entities x clusters) boolean upper approximation membership
+    :arg lower : (entities x clusters) boolean lower approximation membership
+    :arg block_distances : function of (sample entity indices, slice of entities) returning their distance array
+    :arg (optional) weights : weight of each entity (None for 1)
+    :arg (optional) wght_lower, wght_upper : relative weights of lower approximation and boundary region
+    :arg (optional) sample_size : number of entities sampled for silhouette (None to skip)
+    :arg (optional) seed : random seed of silhouette sample
+    :return: dictionary of "lower_sizes", "upper_sizes", "boundary_sizes", "boundary_ratio", "lower_sse",
+        "boundary_sse", "rough_db" and "silhouette"
+    """
+
+    lower_sizes,upper_sizes,boundary_sizes = approximation_sizes(upper,lower,weights)
+    lower_sse,boundary_sse = approximation_sse(features,centroids,upper,lower,weights)
+    quality = {"lower_sizes":lower_sizes,"upper_sizes":upper_sizes,"boundary_sizes":boundary_sizes,
+               "boundary_ratio":boundary_ratio(upper,lower,weights),
+               "lower_sse":lower_sse,"boundary_sse":boundary_sse,
+               "rough_db":rough_davies_bouldin(centroids,lower_sse,boundary_sse,lower_sizes,boundary_sizes,
+                                               wght_lower,wght_upper),
+               "silhouette":np.nan}
+    if sample_size is not None:
+        quality["silhouette"] = sampled_silhouette(block_distances,upper,weights,sample_size,seed=seed)
+
+    return quality
@@ -0,0 +1,325 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+@description
+Local HTTP scoring server for a fitted rough k-means model (saved by RoughKMeans.save_model()). The model is
+loaded once, and concurrent requests are micro-batched: requests queued within max_wait seconds of the first
+request of a batch (up to max_batch entities) are scored together by one vectorized distance and threshold
+computation
+
+Requests:
+    POST /score with JSON body {"entities": [[feature values in model feature order], ...]}
+        or {"features": {<feature_name> : list, ...}}
+        returns {"nearest": [...], "lower": [...], "upper": [[upper approx. clusters], ...]} for each entity
+        (lower approx. cluster is -1 for boundary entities)
+    GET /stats returns request, entity and batch counters, throughput and latency percentiles of scored requests,
+        and the number of failed requests (errors)
+    GET /model returns model feature names, number of clusters and distance threshold
+
+@options
+    max_batch = 256     # Largest number of entities scored in one batch (a larger request is scored alone)
+    max_wait = 0.002    # Seconds to wait for more requests after the first request of a batch
+
+@usage
+    python scoring_server.py <model.npz> [port] [max_batch] [max_wait]
+"""
+
+# Externals
+import json
+import time
+import Queue
+import threading
+import SocketServer
+import BaseHTTPServer
+from sys import argv
+from collections import deque
+import numpy as np
+
+# Package level imports
+from rough_kmeans import RoughKMeansModel
+
+
+class _ScoreRequest:
+
+    def __init__(self,features):
+
+        self.features = features        # (entities x features) array of request
+        self.done = threading.Event()   # Set when scored
+        self.result = None              # (nearest, upper, lower) of request entities
+        self.error = None               # Exception raised scoring batch of request
+        self.submitted = time.time()
+
+
+class MicroBatcher:
+
+    """
+    Score queued requests in batches on a single worker thread, and keep latency and throughput counters
+    """
+
+    def __init__(self,model,max_batch=256,max_wait=0.002):
+
+        self.model = model                  # RoughKMeansModel
+        self.max_batch = max_batch          # Largest number of entities scored in one batch
+        self.max_wait = max_wait            # Seconds to wait for more requests after first request of a batch
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.stopping = False               # Set by stop(), after which requests are refused
+
+        # Counters
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0                   # Requests scored
+        self.entities = 0                   # Entities scored
+        self.batches = 0                    # Batches scored
+        self.errors = 0                     # Requests failed (batch raised, or refused or unscored at stop)
+        self.score_time = 0.0               # Seconds spent scoring batches
+        self.latencies = deque(maxlen=10000)    # Seconds from submit to result of recent scored requests
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+
+        """
+        Refuse new requests, score the requests already queued and stop the worker thread. Any request left
+        in the queue is failed, so no caller waits on it
+        """
+
+        with self.lock:
+            if self.stopping is True:
+                return
+            self.stopping = True
+            self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is not None:
+                self.fail([request],RuntimeError("scoring server stopped"))
+
+    def submit(self,features):
+
+        """
+        Queue request and wait for its batch to be scored
+
+        :arg features : (entities x features) array
+        :return: nearest cluster, (entities x clusters) upper approx. membership and lower approx. cluster of entities
+        """
+
+        request = _ScoreRequest(features)
+        with self.lock:     # Queue ahead of the stop marker, or not at all
+            if self.stopping is True:
+                self.errors += 1
+                raise RuntimeError("scoring server is stopping")
+            self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def run(self):
+
+        """
+        Collect queued requests into batches of up to self.max_batch entities, waiting at most self.max_wait
+        after the first request of each batch, and score them. A request that does not fit in a batch starts
+        the next batch
+        """
+
+        stop = False
+        pending = None
+        while stop is False:
+            request = pending if pending is not None else self.queue.get()
+            pending = None
+            if request is None:
+                return
+            batch = [request]
+            size = len(request.features)
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if size + len(request.features) > self.max_batch:
+                    pending = request   # Keep batch within max_batch
+                    break
+                batch.append(request)
+                size += len(request.features)
+            self.score(batch)
+
+    def score(self,batch):
+
+        """
+        Score a batch of requests in one vectorized model prediction
+
+        :arg batch : list of _ScoreRequest
+        """
+
+        t1 = time.time()
+        try:
+            features = np.vstack([request.features for request in batch])
+            distance_array,nearest,upper,lower = self.model.predict(features)
+            offsets = np.cumsum([len(request.features) for request in batch])[:-1]
+            results = zip(np.split(nearest,offsets),np.split(upper,offsets),np.split(lower,offsets))
+        except Exception as error:
+            self.fail(batch,error)
+            return
+        t2 = time.time()
+
+        with self.lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.entities += len(features)
+            self.score_time += t2 - t1
+            for request in batch:
+                self.latencies.append(t2 - request.submitted)
+        for request,result in zip(batch,results):
+            request.result = result
+            request.done.set()
+
+    def fail(self,batch,error):
+
+        """
+        Fail requests with error, counted as errors only (not in scored requests, batches or latencies)
+
+        :arg batch : list of _ScoreRequest
+        :arg error : exception raised to the callers of submit()
+        """
+
+        with self.lock:
+            self.errors += len(batch)
+        for request in batch:
+            request.error = error
+            request.done.set()
+
+    def stats(self):
+
+        """
+        :return: dictionary of counters, throughput (per second since start) and latency percentiles (milliseconds)
+        """
+
+        with self.lock:
+            uptime = time.time() - self.started
+            latencies = np.asarray(self.latencies) * 1000.
+            stats = {"requests":self.requests,"entities":self.entities,"batches":self.batches,"errors":self.errors,
+                     "uptime":uptime,"score_time":self.score_time,
+                     "requests_per_sec":self.requests / uptime,"entities_per_sec":self.entities / uptime,
+                     "mean_batch_requests":float(self.requests) / max(self.batches,1),
+                     "max_batch":self.max_batch,"max_wait":self.max_wait}
+        if len(latencies) > 0:
+            stats.update({"latency_ms_mean":float(np.mean(latencies)),
+                          "latency_ms_p50":float(np.percentile(latencies,50)),
+                          "latency_ms_p95":float(np.percentile(latencies,95)),
+                          "latency_ms_p99":float(np.percentile(latencies,99))})
+
+        return stats
+
+
+class ScoringHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"   # Keep client connections open across requests
+    disable_nagle_algorithm = True  # Send small responses without delay
+    wbufsize = -1                   # Buffer response (flushed once per request)
+
+    def do_GET(self):
+
+        if self.path == "/stats":
+            self.send_json(200,self.server.batcher.stats())
+        elif self.path == "/model":
+            model = self.server.batcher.model
+            self.send_json(200,{"feature_names":model.feature_names,"clusters":len(model.centroids),
+                                "dist_threshold":model.dist_threshold})
+        else:
+            self.send_json(404,{"error":"unknown path %s" % self.path})
+
+    def do_POST(self):
+
+        if self.path != "/score":
+            self.send_json(404,{"error":"unknown path %s" % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader("content-length",0))))
+            model = self.server.batcher.model
+            if "features" in body:
+                features = np.column_stack([np.asarray(body["features"][name],dtype=np.float64)
+                                            for name in model.feature_names])
+            else:
+                features = np.array(body["entities"],dtype=np.float64,ndmin=2)
+            if features.shape[1] != len(model.feature_names):
+                raise ValueError("expected %d features per entity" % len(model.feature_names))
+        except (ValueError,KeyError,TypeError) as error:
+            self.send_json(400,{"error":str(error)})
+            return
+
+        try:
+            nearest,upper,lower = self.server.batcher.submit(features)
+        except Exception as error:
+            self.send_json(500,{"error":str(error)})
+            return
+        clusters = np.split(np.nonzero(upper)[1],np.cumsum(np.sum(upper,axis=1))[:-1])
+        self.send_json(200,{"nearest":nearest.tolist(),"lower":lower.tolist(),
+                            "upper":[entity.tolist() for entity in clusters]})
+
+    def send_json(self,status,payload):
+
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+
+        if self.server.debug is True:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+class ScoringServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+
+    """
+    Threaded HTTP server (one thread per connection) whose handlers submit requests to a shared MicroBatcher
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,model,host="127.0.0.1",port=8080,max_batch=256,max_wait=0.002):
+
+        BaseHTTPServer.HTTPServer.__init__(self,(host,port),ScoringHandler)
+        self.batcher = MicroBatcher(model,max_batch,max_wait)
+        self.batcher.start()
+        self.debug = False      # Debug flag for request log print statements
+
+    def server_close(self):
+
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.batcher.stop()
+
+
+if __name__ == "__main__":
+
+    server = ScoringServer(RoughKMeansModel.load(argv[1]),port=int(argv[2]) if len(argv) > 2 else 8080,
+                           max_batch=int(argv[3]) if len(argv) > 3 else 256,
+                           max_wait=float(argv[4]) if len(argv) > 4 else 0.002)
+    print "Serving rough k-means model",argv[1],"on port",server.server_address[1]
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+Usage examples and consistency checks for rough set clustering class options on a small synthetic data set of
+integer features around three centers (no data files needed). Each check prints whether an option reproduces
+the default path
+"""
+
+# Externals
+import os
+import time
+import shutil
+import tempfile
+import numpy as npy
+
+# Package level imports from /code
+from code import RoughCluster
+
+# Set some rough clustering parameters
+max_clusters = 3    # Number of clusters to return
+
+
+def optimal_clusters(clust):
+
+    """
+    :return: optimal distance D and sorted entity keys of each optimal cluster
+    """
+
+    return clust.opt_d,{key : sorted(members,key=int) for key,members in
+                        clust.optimal[clust.opt_d]["cluster_list"][max_clusters].items()}
+
+
+# Integer features scattered around three centers
+state = npy.random.RandomState(0)
+centers = state.randint(0,10,(3,6))
+data_array = npy.clip(centers[state.randint(0,3,300)] + state.randint(-1,2,(300,6)),0,9)
+data = {"f"+str(f): data_array[:,f] for f in range(data_array.shape[1])}
+
+# Instantiate and run rough clustering over all distances D
+t1 = time.time()
+clust = RoughCluster(data,max_clusters,"ratio",None)
+clust.get_entity_distances()
+clust.enumerate_clusters()
+clust.prune_clusters(optimize=True)
+t2 = time.time()
+print "Rough Set Clustering Took: ",t2-t1," secs"
+print "Optimal Intra-Entity Distance",clust.opt_d
+print "Optimal Cluster Sizes",{key : len(members) for key,members in optimal_clusters(clust)[1].items()}
+
+# Lazy evaluation of distances D reproduces the optimal clusters of all distances D
+lazy = RoughCluster(data,max_clusters,"ratio",None)
+lazy.get_entity_distances()
+lazy.enumerate_optimal_clusters()
+print "Lazy Evaluation Reproduces Optimal Clusters",optimal_clusters(lazy) == optimal_clusters(clust)
+
+# Approximate (LSH) near pairs are a subset of the exact near pairs, and their estimated recall is close to the
+# fraction of exact near pairs found
+approx = RoughCluster(data,max_clusters,"ratio",clust.maxD)
+approx.approximate = True
+approx.get_entity_distances()
+exact_pairs = set(map(tuple,clust.pair_index.tolist()))
+approx_pairs = set(map(tuple,approx.pair_index.tolist()))
+print "Approximate Pairs Are Exact Near Pairs",approx_pairs <= exact_pairs
+print "Approximate Pair Recall (Estimated, Found)",approx.pair_recall,len(approx_pairs) / float(len(exact_pairs))
+
+# Adding entities to a fit reproduces the clusters of refitting all entities (at the same maximum distance D)
+incremental = RoughCluster({key : values[0:250] for key,values in data.items()},max_clusters,"ratio",clust.maxD)
+incremental.get_entity_distances()
+incremental.enumerate_clusters()
+incremental.prune_clusters(optimize=True)
+incremental.add_entities({key : values[250:] for key,values in data.items()})
+print "Added Entities Reproduce Refit Clusters",optimal_clusters(incremental) == optimal_clusters(clust)
+
+# Clusters streamed from a disk-backed distance matrix reproduce the in-memory clusters, and a second run reuses the file
+distance_dir = tempfile.mkdtemp()
+modified = []
+for run in range(2):
+    stored = RoughCluster(data,max_clusters,"ratio",None)
+    stored.distance_file = os.path.join(distance_dir,"distances.npy")
+    stored.get_entity_distances()
+    stored.enumerate_clusters()
+    stored.prune_clusters(optimize=True)
+    modified.append(os.stat(stored.distance_file).st_mtime)
+    print "Distance File Run",run,"Reproduces In-Memory Clusters",optimal_clusters(stored) == optimal_clusters(clust)
+print "Distance File Reused",modified[0] == modified[1]
+shutil.rmtree(distance_dir)
+
+# Quality metrics of the optimal clusters agree with their approximation sums
+quality = clust.quality[max_clusters]
+print "Quality of Optimal Clusters",{key : quality[key] for key in ["boundary_ratio","rough_db","silhouette"]}
+print "Quality Sizes Agree With Approximation Sums",\
+    npy.sum(quality["lower_sizes"]) == clust.optimal[clust.opt_d]["sum_lower"][max_clusters] and \
+    npy.sum(quality["upper_sizes"]) == clust.optimal[clust.opt_d]["sum_upper"][max_clusters]
@@ -14,43 +14,28 @@ University of California, School of Information and Computer Science.
 
 # Externals
 import time
-import json
 from collections import Counter
 import matplotlib.pyplot as plt
 import numpy as npy
 from scipy.cluster.vq import kmeans2
 
 # Package level imports from /code
-from code import RoughCluster,RoughKMeans
+from code import RoughCluster,RoughKMeans,ColumnLoader
 
 # Set some rough clustering parameters
 maxD = 20			# if None, maxD will be determined by algorithm
 max_clusters = 2    # Number of clusters to return
 
-# Load some data
-file2 = open("german_all.json","r")
-data = json.load(file2)
-print data.keys()
-
-# Do some numerical encoding for input payload
-header = []
-data2 = {}
-for key in data["payload"].keys():
-    header.append(key)
-    try:
-        data2[key] = [int(data["payload"][key][m]) for m in range(0,len(data["payload"][key]))]
-        if key == "amount":
-            data2[key] = []
-            for n in range(len(data["payload"][key])):
-                bins = [0,1500,3000,8000,20000]
-                for i,val in enumerate(bins[0:-1]):
-                    if (int(data["payload"][key][n])) >= val and (int(data["payload"][key][n]) < bins[i+1]):
-                        data2[key].append(i+1)
-    except:
-        data2[key] = []
-        encoding = {key : m for m,key in enumerate(Counter(data["payload"][key]).keys())}
-        for n in range(len(data["payload"][key])):
-            data2[key].append(encoding[data["payload"][key][n]])
+# Load payload features as typed columns (non-numeric features encoded to integers) and responses
+loader = ColumnLoader("german_all.json")
+loader.key = "payload"
+data2 = loader.load()
+header = data2.keys()
+response = ColumnLoader("german_all.json",columns=["response"]).load()["response"]
+print header
+
+# Bin amount feature
+data2["amount"] = npy.digitize(data2["amount"],[0,1500,3000,8000,20000])
 
 # Instantiate and run rough clustering
 t1 = time.time()
@@ -61,6 +46,25 @@ clust.prune_clusters(optimize=True)
 t2 = time.time()
 print "Rough Set Clustering Took: ",t2-t1," secs"
 
+# Collapsing duplicate entities reproduces the clusters of all entities on data with many duplicates
+dup_array = npy.random.RandomState(0).randint(0,3,(500,4))
+dup_data = {str(f): dup_array[:,f] for f in range(dup_array.shape[1])}
+dup_clusts = []
+for collapse in [False,True]:
+    dup_clust = RoughCluster(dup_data,3,"ratio",None)
+    dup_clust.collapse_duplicates = collapse
+    dup_clust.get_entity_distances()
+    dup_clust.enumerate_clusters()
+    dup_clust.prune_clusters(optimize=True)
+    dup_clusts.append(dup_clust)
+print "Unique Entities of Duplicated Data",dup_clusts[1].data_array.shape[0]
+print "Collapsed Duplicates Reproduce Approximation Sums",dup_clusts[0].sum_lower == dup_clusts[1].sum_lower and \
+    dup_clusts[0].sum_upper == dup_clusts[1].sum_upper
+dup_optimal = [{key : sorted(members,key=int) for key,members in dup.optimal[dup.opt_d]["cluster_list"][3].items()}
+               for dup in dup_clusts]
+print "Collapsed Duplicates Reproduce Optimal Clusters",dup_clusts[0].opt_d == dup_clusts[1].opt_d and \
+    dup_optimal[0] == dup_optimal[1]
+
 # Run rough kmeans as well
 clstrk = RoughKMeans(data2,2,0.75,0.25,1.2)
 clstrk.get_rough_clusters()
@@ -70,8 +74,8 @@ print "rough kmeans",clstrk.centroids
 # Compare results with known centroid mean and std deviations as well as those from k-means
 # Print stats for members of clusters
 # Determine labels from known classes for "good" and "bad" credit risk
-list1 = [i for i in range(len(data["response"])) if data["response"][i] == '1']
-list2 = [i for i in range(len(data["response"])) if data["response"][i] == '2']
+list1 = [i for i in range(len(response)) if response[i] == 1]
+list2 = [i for i in range(len(response)) if response[i] == 2]
 
 tableau_lists = []
 tableau_1 = []
@@ -97,7 +101,7 @@ val = [[] for n in range(len(groups))]
 for m in range(len(groups)):
     for n in range(2):
         if groups[m] == n:
-            val[n].append(data["response"][m])
+            val[n].append(response[m])
             meank[n].append(datav[int(val[n][-1]),:])
 meankp = []
 stddevk = []
@@ -110,7 +114,7 @@ resultsm = []
 resultss = []
 rangek = [l+.2 for l in range(20)]
 ranger = [l+.1 for l in range(20)]
-print "total instances",Counter(data["response"])
+print "total instances",Counter(response)
 
 key1 = clust.opt_d 	# Optimal distance D to plot
 fig, axs = plt.subplots(nrows=1,ncols=1)
@@ -129,7 +133,7 @@ for key in clust.pruned[key1]["cluster_list"][max_clusters]:
     meant = []
     stdt = []
     for val in clust.pruned[key1]["cluster_list"][max_clusters][key]:
-        meant.append(data["response"][int(val)])
+        meant.append(response[int(val)])
         datav2.append(datav[int(val),:])
     tmp = npy.mean(npy.asarray(datav2),axis=0)
     tmp2 = npy.std(npy.asarray(datav2),axis=0)
@@ -14,10 +14,28 @@ import json
 from sys import argv
 from collections import Counter
 from copy import deepcopy
+import numpy as np
 
 # Package level imports from /code
 from code import RoughKMeans
 
+
+class CancelAfter:
+
+    """
+    Cancellation token set once it has been checked a number of times
+    """
+
+    def __init__(self,checks):
+
+        self.checks = checks
+
+    def is_set(self):
+
+        self.checks -= 1
+        return self.checks < 0
+
+
 # Load data from file
 data_file = "iris_dataset.json"
 dfile = open(data_file, "r")
@@ -47,15 +65,87 @@ clstrk.get_rough_clusters()
 t3 = time.time()
 
 print "Rough Kmeans Clustering Took: ",t3-t2," secs"
+lower_sizes, upper_sizes, boundary_sizes = clstrk.membership.sizes()
+target_values, lower_table = clstrk.membership.contingency(targets,"lower")
+target_values, upper_table = clstrk.membership.contingency(targets,"upper")
 for i in range(clstrk.max_clusters):
     clt1 = str(i)
     print "GROUP",clt1
-    print "Totals Group",clt1,len(clstrk.clusters[clt1]["lower"]),len(clstrk.clusters[clt1]["upper"])
+    print "Totals Group",clt1,lower_sizes[i],upper_sizes[i]
+
+    print "Lower vs Target 0",lower_table[i,0]
+    print "Lower vs Target 1",lower_table[i,1]
+    print "Lower vs Target 2",lower_table[i,2]
+
+    print "Upper vs Target 0",upper_table[i,0]
+    print "Upper vs Target 1",upper_table[i,1]
+    print "Upper vs Target 2",upper_table[i,2]
+
+# Sweep k = 2..5 in one pass by bisection, and compare the k = 3 rough cost with the fit above
+sweep = RoughKMeans(data2["data_set"],3,wght_lower=0.9,wght_upper=0.1,threshold=1.0,p_param=1.,wght=False)
+sweep.sweep_clusters(5)
+sweep_costs = [sweep.sweep[k]["cost"] for k in sorted(sweep.sweep)]
+print "Sweep Rough Cost by k",dict(zip(sorted(sweep.sweep),sweep_costs))
+print "Sweep Rough Cost Decreases with k",all(sweep_costs[k+1] <= sweep_costs[k] for k in range(len(sweep_costs)-1))
+print "Sweep vs Fit Rough Cost at k = 3",sweep.sweep[3]["cost"],sum(clstrk.get_rough_cost().values())
+
+# Integer sample weights reproduce the fit of entities repeated by their weight (from the same initial centroids)
+sample_weight = np.random.RandomState(0).randint(1,4,num_users)
+weighted = RoughKMeans(data2["data_set"],3,wght_lower=0.9,wght_upper=0.1,threshold=1.2,sample_weight=sample_weight)
+weighted.transform_data()
+weighted.initialize_centroids()
+initial_centroids = deepcopy(weighted.centroids)
+weighted.converge_centroids()
+expanded = RoughKMeans({key : np.repeat(values,sample_weight) for key,values in data2["data_set"].items()},3,
+                       wght_lower=0.9,wght_upper=0.1,threshold=1.2)
+expanded.transform_data()
+expanded.centroids = deepcopy(initial_centroids)
+expanded.converge_centroids()
+print "Weighted Fit Reproduces Expanded Centroids",all(np.allclose(weighted.centroids[key],expanded.centroids[key])
+                                                       for key in weighted.centroids)
+print "Weighted Fit Reproduces Expanded Approximations",np.array_equal(np.repeat(weighted.lower,sample_weight,axis=0),
+                                                                       expanded.lower) and \
+    np.array_equal(np.repeat(weighted.upper,sample_weight,axis=0),expanded.upper)
+
+# float32 compute reproduces the float64 approximations (from the same initial centroids)
+precision = {}
+for dtype in [np.float64,np.float32]:
+    precision[dtype] = RoughKMeans(data2["data_set"],3,wght_lower=0.9,wght_upper=0.1,threshold=1.2)
+    precision[dtype].dtype = dtype
+    precision[dtype].transform_data()
+    precision[dtype].centroids = {key : values.astype(dtype) for key,values in initial_centroids.items()}
+    precision[dtype].converge_centroids()
+print "float32 Reproduces float64 Approximations",\
+    np.array_equal(precision[np.float32].lower,precision[np.float64].lower) and \
+    np.array_equal(precision[np.float32].upper,precision[np.float64].upper)
+print "float32 Max Centroid Difference",max(np.max(np.abs(precision[np.float32].centroids[key] -
+                                                          precision[np.float64].centroids[key]))
+                                            for key in initial_centroids)
 
-    print "Lower vs Target 0",len(set(clstrk.clusters[clt1]["lower"]).intersection(set(list0)))
-    print "Lower vs Target 1",len(set(clstrk.clusters[clt1]["lower"]).intersection(set(list1)))
-    print "Lower vs Target 2",len(set(clstrk.clusters[clt1]["lower"]).intersection(set(list2)))
+# A fit cancelled after 2 iterations (3 checks per iteration) returns the best solution so far, the same as a fit
+# limited to 2 iterations, and a fit out of time budget returns the approximations of its initial centroids
+stopped = {}
+for stop in ["max_iter","cancelled","time_budget"]:
+    stopped[stop] = RoughKMeans(data2["data_set"],3,wght_lower=0.9,wght_upper=0.1,threshold=1.2)
+    stopped[stop].transform_data()
+    stopped[stop].centroids = deepcopy(initial_centroids)
+    if stop == "max_iter":
+        stopped[stop].max_iter = 2
+    elif stop == "cancelled":
+        stopped[stop].cancel_token = CancelAfter(6)
+    else:
+        stopped[stop].time_budget = 0.
+    stopped[stop].converge_centroids()
+    print "Stopped Fit Status",stop,stopped[stop].status,"after",stopped[stop].iterations,"iterations"
+print "Cancelled Fit Returns Best Solution So Far",\
+    all(np.array_equal(stopped["cancelled"].centroids[key],stopped["max_iter"].centroids[key])
+        for key in initial_centroids) and np.array_equal(stopped["cancelled"].lower,stopped["max_iter"].lower)
+print "Cancelled Fit Skips Quality",stopped["cancelled"].quality is None
+print "Time Budget Fit Returns Initial Centroids",all(np.array_equal(stopped["time_budget"].centroids[key],
+                                                                     initial_centroids[key]) for key in initial_centroids)
 
-    print "Upper vs Target 0",len(set(clstrk.clusters[clt1]["upper"]).intersection(set(list0)))
-    print "Upper vs Target 1",len(set(clstrk.clusters[clt1]["upper"]).intersection(set(list1)))
-    print "Upper vs Target 2", len(set(clstrk.clusters[clt1]["upper"]).intersection(set(list2)))
+# Quality metrics computed during fitting agree with the membership of the fit
+print "Quality of Fit",{key : clstrk.quality[key] for key in ["boundary_ratio","rough_db","silhouette"]}
+print "Quality Sizes Agree With Membership",all(np.array_equal(clstrk.quality[key],sizes) for key,sizes in
+                                                zip(["lower_sizes","upper_sizes","boundary_sizes"],
+                                                    clstrk.membership.sizes()))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python2.7
+# encoding: utf-8
+
+"""
+Load generator and usage example for the rough k-means scoring server using UCI iris data set: fits and saves
+a model, serves it on localhost, and sends concurrent scoring requests from several client threads
+
+usage: python rough_kmeans_server_load.py [clients] [requests per client] [entities per request] [max_batch] [max_wait]
+"""
+
+# Externals
+import os
+import time
+import json
+import socket
+import httplib
+import tempfile
+import threading
+from sys import argv
+import numpy as np
+
+# Package level imports from /code
+from code import RoughKMeans
+from code.rough_kmeans import RoughKMeansModel
+from code.scoring_server import ScoringServer
+
+num_clients = int(argv[1]) if len(argv) > 1 else 8
+num_requests = int(argv[2]) if len(argv) > 2 else 200
+request_size = int(argv[3]) if len(argv) > 3 else 4
+max_batch = int(argv[4]) if len(argv) > 4 else 256
+max_wait = float(argv[5]) if len(argv) > 5 else 0.002
+
+# Fit and save model
+dfile = open("iris_dataset.json", "r")
+data2 = json.load(dfile)
+dfile.close()
+clstrk = RoughKMeans(data2["data_set"],3,wght_lower=0.9,wght_upper=0.1,threshold=1.2)
+clstrk.normalize = True
+clstrk.timing = False
+clstrk.get_rough_clusters()
+model_file = os.path.join(tempfile.mkdtemp(),"iris_model.npz")
+clstrk.save_model(model_file)
+
+# Serve model on localhost (free port)
+model = RoughKMeansModel.load(model_file)
+server = ScoringServer(model,port=0,max_batch=max_batch,max_wait=max_wait)
+server_thread = threading.Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+port = server.server_address[1]
+
+# Scoring saved model reproduces fitted assignments
+distance_array,nearest,upper,lower = model.predict(np.column_stack([data2["data_set"][key] for key in clstrk.keylist]))
+print "Model reproduces fitted lower approximations",np.array_equal(lower,clstrk.lower)
+print "Model reproduces fitted upper approximations",np.array_equal(upper,clstrk.upper)
+
+entities = np.column_stack([data2["data_set"][key] for key in model.feature_names])
+latencies = []
+mismatches = []
+
+
+def client(seed):
+
+    rng = np.random.RandomState(seed)
+    connection = httplib.HTTPConnection("127.0.0.1",port)
+    connection.connect()
+    connection.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    for n in range(num_requests):
+        rows = rng.randint(0,len(entities),request_size)
+        body = json.dumps({"entities":entities[rows].tolist()})
+        t1 = time.time()
+        connection.request("POST","/score",body,{"Content-Type":"application/json"})
+        result = json.loads(connection.getresponse().read())
+        latencies.append(time.time() - t1)
+        if result["lower"] != lower[rows].tolist():
+            mismatches.append(rows)
+    connection.close()
+
+# Run concurrent clients
+t2 = time.time()
+clients = [threading.Thread(target=client,args=(k,)) for k in range(num_clients)]
+for thread in clients:
+    thread.start()
+for thread in clients:
+    thread.join()
+t3 = time.time()
+
+print "Clients",num_clients,"Requests per client",num_requests,"Entities per request",request_size
+print "Requests per sec: ",num_clients*num_requests/(t3-t2)
+print "Client latency ms p50/p95/p99: ",np.percentile(np.asarray(latencies)*1000.,[50,95,99])
+print "Responses differing from model: ",len(mismatches)
+
+connection = httplib.HTTPConnection("127.0.0.1",port)
+connection.request("GET","/stats")
+stats = json.loads(connection.getresponse().read())
+connection.close()
+for key in sorted(stats):
+    print "Server",key,stats[key]
+
+server.shutdown()
+server.server_close()
@@ -62,16 +62,18 @@ clstrk.get_rough_clusters()
 t3 = time.time()
 
 print "Rough Kmeans Clustering Took: ",t3-t2," secs"
+lower_sizes, upper_sizes, boundary_sizes = clstrk.membership.sizes()
+target_values, lower_table = clstrk.membership.contingency(data2["response"],"lower")
+target_values, upper_table = clstrk.membership.contingency(data2["response"],"upper")
 for i in range(clstrk.max_clusters):
     clt1 = str(i)
     print "GROUP",clt1
-    print "Totals Unique Enitities",clt1,len(clstrk.clusters[clt1]["lower"])
-    print "Total All Entities",len(clstrk.clusters[clt1]["upper"])
-    print "Total Non-Unique Entities",\
-        len(set(clstrk.clusters[clt1]["upper"]).difference(set(clstrk.clusters[clt1]["lower"])))
+    print "Totals Unique Enitities",clt1,lower_sizes[i]
+    print "Total All Entities",upper_sizes[i]
+    print "Total Non-Unique Entities",boundary_sizes[i]
 
-    print "Lower vs Target 0",len(set(clstrk.clusters[clt1]["lower"]).intersection(set(list1)))
-    print "Lower vs Target 1",len(set(clstrk.clusters[clt1]["lower"]).intersection(set(list2)))
+    print "Lower vs Target 0",lower_table[i,0]
+    print "Lower vs Target 1",lower_table[i,1]
 
-    print "Upper vs Target 0",len(set(clstrk.clusters[clt1]["upper"]).intersection(set(list1)))
-    print "Upper vs Target 1",len(set(clstrk.clusters[clt1]["upper"]).intersection(set(list2)))
\ No newline at end of file
+    print "Upper vs Target 0",upper_table[i,0]
+    print "Upper vs Target 1",upper_table[i,1]